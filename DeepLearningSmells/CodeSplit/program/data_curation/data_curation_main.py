@@ -5,6 +5,7 @@
 # are generated by previous steps.
 
 # -- imports --
+import sys
 import cs_designite_runner
 import cs_code_split_runner
 import cs_learning_data_generator
@@ -32,6 +33,8 @@ CS_LEARNING_DATA_FOLDER_BASE = DATA_BASE_PATH + r'\training_data'
 
 # TOKENIZER_EXE_PATH = "/Users/Tushar/Documents/Research/smellDetectionML/tokenizer/src/tokenizer"
 TOKENIZER_EXE_PATH = r'D:\research\smellDetectionML\tokenizer\src\tokenizer.exe'
+# With --force, the tokenizer output folders are wiped and tokenized again instead of resuming an interrupted run
+TOKENIZER_FORCE = "--force" in sys.argv[1:]
 CS_TOKENIZER_OUT_PATH = DATA_BASE_PATH + r'\tokenizer_out'
 # CS_TOKENIZER_OUT_PATH = "/Users/Tushar/Documents/Research/smellDetectionML/data/tokenizer_out_cs"
 
@@ -72,7 +75,8 @@ if __name__ == "__main__":
     #                                        CS_CODE_SPLIT_OUT_FOLDER_METHOD, CS_LEARNING_DATA_FOLDER_BASE)
 
     # 4. Run tokenizer to convert code fragments into vectors/matrices of numbers that can be fed to neural network.
-    # tokenizer_runner.tokenize("CSharp", CS_LEARNING_DATA_FOLDER_BASE, CS_TOKENIZER_OUT_PATH, TOKENIZER_EXE_PATH)
+    # tokenizer_runner.tokenize("CSharp", CS_LEARNING_DATA_FOLDER_BASE, CS_TOKENIZER_OUT_PATH, TOKENIZER_EXE_PATH,
+    #                           force=TOKENIZER_FORCE)
 
     # 5-8. We repeat the step 1 to 4 for Java repositories
     # 5. Run DesigniteJava to analyze Java repositories
@@ -93,4 +97,5 @@ if __name__ == "__main__":
     #                                            JAVA_CODE_SPLIT_OUT_FOLDER_METHOD, JAVA_LEARNING_DATA_FOLDER_BASE)
 
     # 8. Run tokenizer to convert code fragments into vectors/matrices of numbers that can be fed to neural network.
-    tokenizer_runner.tokenize("Java", JAVA_LEARNING_DATA_FOLDER_BASE, JAVA_TOKENIZER_OUT_PATH, TOKENIZER_EXE_PATH)
\ No newline at end of file
+    tokenizer_runner.tokenize("Java", JAVA_LEARNING_DATA_FOLDER_BASE, JAVA_TOKENIZER_OUT_PATH, TOKENIZER_EXE_PATH,
+                              force=TOKENIZER_FORCE)
\ No newline at end of file
@@ -1,7 +1,33 @@
+import io
+import json
+import locale
 import os
+import runpy
 import subprocess
 import shutil
 import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+# Number of long-lived processes that run the tokenizer script in process on batches of files. 0 (the
+# default) starts a new interpreter for every file. The in process mode is opt-in: the tokenizer then keeps
+# its module level state from one file to the next and output it writes past sys.stdout (os.write) is lost,
+# so check that it gives the same shards as the default mode before using it.
+TOKENIZER_WORKERS = 0
+# Number of tokenizer interpreters running at the same time across the jobs when TOKENIZER_WORKERS is 0
+TOKENIZER_PROCESSES = os.cpu_count() or 1
+# Number of files sent to a tokenizer worker at a time; a job reports its progress after every batch
+TOKENIZE_BATCH = 64
+MAX_SHARD_BYTES = 52428800  # 50 mb; a shard is closed once it is over this size
+WRITE_BUFFER = 8 * 1024 * 1024  # bytes of tokenizer output buffered in memory per shard
+# Checkpoint of the fragments of an output folder committed to its shards, one JSON line per fragment after
+# a line with the tokenizer settings. It starts with "." so that the folder walkers of dl_models skip it.
+TOKENIZE_MANIFEST = ".tokenize_manifest.jsonl"
 
 
 # To figure out whether a file contains multiple definitions of a method,
@@ -26,39 +52,277 @@ def _is_contain_overloaded_methods(input_file, tokenizer_path, tokenizer_languag
     return False
 
 
-def _run_tokenizer(folder_path, out_folder, tokenizer_path, tokenizer_language, tokenizer_level):
-    if os.path.exists(out_folder):
-        shutil.rmtree(out_folder)
-    os.makedirs(out_folder)
-    file_counter = 1
-    out_file = os.path.join(out_folder, "tokenized" + str(file_counter) + ".tok")
-    for file in os.listdir(folder_path):
-        input_file = os.path.abspath(os.path.join(folder_path, file))
+# The tokenizer output decoded the way the former temp.tok file was read back
+def _decode_output(output):
+    return io.TextIOWrapper(io.BytesIO(output), errors='ignore').read()
+
+
+# The tokenizer output of one file, piped from a new interpreter. The interpreter runs once a slot (the
+# semaphore shared by the jobs of tokenize) is free.
+def _tokenize_subprocess(input_file, exe_path, tokenizer_language, tokenizer_level, slots=None):
+    # process = subprocess.Popen([exe_path, "-l", tokenizer_language, "-o",
+    #                             tokenizer_level, input_file],
+    #                            bufsize=10240000, stdout=tok_out_file, shell=True)
+    with slots if slots is not None else nullcontext():
+        completed = subprocess.run([sys.executable, exe_path, "-l", tokenizer_language, "-o",
+                                    tokenizer_level, input_file], stdout=subprocess.PIPE)
+    return _decode_output(completed.stdout)
+
+
+def _init_tokenizer_worker(exe_path):
+    sys.path.insert(0, os.path.dirname(exe_path))
+
+
+# Runs the tokenizer script on one file inside the worker, the way "python tokenizer ..." would: its
+# standard output is captured in memory
+def _tokenize_in_process(input_file, exe_path, tokenizer_language, tokenizer_level):
+    stdout = sys.stdout
+    argv = sys.argv
+    sys.stdout = io.TextIOWrapper(io.BytesIO())
+    sys.argv = [exe_path, "-l", tokenizer_language, "-o", tokenizer_level, input_file]
+    try:
+        runpy.run_path(exe_path, run_name="__main__")
+    except SystemExit:
+        pass
+    except Exception:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        output = sys.stdout.buffer.getvalue()
+        sys.stdout = stdout
+        sys.argv = argv
+    return _decode_output(output)
+
+
+def _tokenize_batch(input_files, exe_path, tokenizer_language, tokenizer_level):
+    return [_tokenize_in_process(input_file, exe_path, tokenizer_language, tokenizer_level)
+            for input_file in input_files]
+
+
+def _tokenizer_pool(exe_path, workers):
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_tokenizer_worker, initargs=(exe_path,))
+
+
+# At most window batches of the files are submitted at a time, so the jobs sharing executor take turns
+# instead of the first one queuing all its batches ahead of the others
+def _map_batches(executor, input_files, exe_path, tokenizer_language, tokenizer_level, window):
+    tokenize_batch = partial(_tokenize_batch, exe_path=exe_path, tokenizer_language=tokenizer_language,
+                             tokenizer_level=tokenizer_level)
+    in_flight = deque()
+    for i in range(0, len(input_files), TOKENIZE_BATCH):
+        in_flight.append(executor.submit(tokenize_batch, input_files[i:i + TOKENIZE_BATCH]))
+        if len(in_flight) >= window:
+            for tok_text in in_flight.popleft().result():
+                yield tok_text
+    while len(in_flight) > 0:
+        for tok_text in in_flight.popleft().result():
+            yield tok_text
+
+
+# The tokenizer output of every input file, in the order of input_files. The batches go to executor when
+# one is given (the pool shared by the jobs of tokenize), otherwise to a pool of workers processes. With
+# workers=0 every file gets its own interpreter, within the slots when they are given.
+def _tokenized_texts(input_files, exe_path, tokenizer_language, tokenizer_level, workers, executor=None,
+                     slots=None):
+    if workers == 0:
+        for input_file in input_files:
+            yield _tokenize_subprocess(input_file, exe_path, tokenizer_language, tokenizer_level, slots)
+        return
+    if executor is not None:
+        for tok_text in _map_batches(executor, input_files, exe_path, tokenizer_language, tokenizer_level, workers):
+            yield tok_text
+        return
+    with _tokenizer_pool(exe_path, workers) as executor:
+        for tok_text in _map_batches(executor, input_files, exe_path, tokenizer_language, tokenizer_level, workers):
+            yield tok_text
+
+
+def _report_progress(job_name, done, total, start):
+    elapsed = max(time.time() - start, 1e-6)
+    print("\t\t{0}: {1}/{2} files, {3:.1f} files/s".format(job_name, done, total, done / elapsed))
+
+
+# Appends text to the tokenizedN.tok shards of a folder and starts a new shard once the current one is over
+# max_bytes. The text is encoded as a text mode file would write it, so the shard size is counted here
+# instead of asking the file system after every file; the shard is written through a buffer_size buffer.
+# A resumed writer continues shard file_counter, which already holds size bytes.
+class ShardWriter:
+    def __init__(self, out_folder, max_bytes=MAX_SHARD_BYTES, buffer_size=WRITE_BUFFER, file_counter=1, size=0):
+        self.out_folder = out_folder
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.encoding = locale.getpreferredencoding(False)
+        self.file_counter = file_counter
+        self.writer = None
+        self.size = size
+
+    def shard_name(self):
+        return "tokenized" + str(self.file_counter) + ".tok"
+
+    # Returns the shard the text went to and the size of that shard after it
+    def write(self, text):
+        if self.writer is None:
+            self.writer = open(os.path.join(self.out_folder, self.shard_name()), "ab", buffering=self.buffer_size)
+        data = text.replace("\n", os.linesep).encode(self.encoding, errors='ignore')
+        self.writer.write(data)
+        self.size += len(data)
+        shard, end = self.shard_name(), self.size
+        if self.size > self.max_bytes:
+            self.close()
+            self.file_counter += 1
+            self.size = 0
+        return shard, end
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+# The fragments an earlier run with the same settings committed to the shards of out_folder, as
+# {"file", "shard", "end"} records in the order they were written; None when there is no such run
+def _read_checkpoint(out_folder, settings):
+    try:
+        with open(os.path.join(out_folder, TOKENIZE_MANIFEST), "r") as reader:
+            lines = reader.readlines()
+    except OSError:
+        return None
+    records = []
+    for line in lines:
         try:
-            print("\t\tprocessing " + file)
-        except:
-            pass
-        in_file = os.path.abspath(os.path.join(out_folder, "temp.tok"))
-        if os.path.exists(in_file):
-            os.remove(in_file)
-        with open(in_file, "w", errors='ignore') as tok_out_file:
-            exe_path = os.path.abspath(tokenizer_path)
-            # process = subprocess.Popen([exe_path, "-l", tokenizer_language, "-o",
-            #                             tokenizer_level, input_file],
-            #                            bufsize=10240000, stdout=tok_out_file, shell=True)
-
-            subprocess.run([sys.executable, exe_path, "-l", tokenizer_language, "-o",
-                            tokenizer_level, input_file], stdout=tok_out_file)
-            # process.wait()
-
-        with open(out_file, "a", errors='ignore') as f:
-            with open(in_file, "r", errors='ignore') as in_f:
-                tok_text = in_f.read()
-            f.write(tok_text.lstrip("b'").rstrip("'\\n"))
-        os.remove(in_file)
-        if os.path.getsize(out_file) > 52428800:  # 50 mb
+            records.append(json.loads(line))
+        except ValueError:
+            break  # the last line was cut by a crash
+    if len(records) == 0 or records[0] != settings:
+        return None
+    return records[1:]
+
+
+# Drops what was written to the shards after the last committed fragment and returns the writer that
+# continues after it
+def _resume_shards(out_folder, committed, max_bytes=MAX_SHARD_BYTES):
+    file_counter = 1
+    size = 0
+    if len(committed) > 0:
+        file_counter = int(committed[-1]["shard"][len("tokenized"):-len(".tok")])
+        size = committed[-1]["end"]
+        if size > max_bytes:
             file_counter += 1
-            out_file = os.path.join(out_folder, "tokenized" + str(file_counter) + ".tok")
+            size = 0
+    for file in os.listdir(out_folder):
+        if file.startswith("tokenized") and file.endswith(".tok") and \
+                int(file[len("tokenized"):-len(".tok")]) >= file_counter:
+            if file == "tokenized" + str(file_counter) + ".tok" and size > 0:
+                os.truncate(os.path.join(out_folder, file), size)
+            else:
+                os.remove(os.path.join(out_folder, file))
+    return ShardWriter(out_folder, max_bytes, file_counter=file_counter, size=size)
+
+
+def _write_records(checkpoint, records):
+    for record in records:
+        checkpoint.write(json.dumps(record) + "\n")
+    checkpoint.flush()
+
+
+# The 1d text of a fragment derived from its statement level text: the statements of every method (a block
+# of lines ended by an empty line) joined with tabs into one line, or the statements of the whole fragment
+# into one line for the file level
+def _derive_1d(tok_text, tokenizer_level):
+    blocks = []
+    cur_block = []
+    for line in tok_text.split("\n"):
+        if line.strip() == "":
+            if len(cur_block) > 0:
+                blocks.append(cur_block)
+            cur_block = []
+        else:
+            cur_block.append(line)
+    if len(cur_block) > 0:
+        blocks.append(cur_block)
+    if tokenizer_level == "file":
+        blocks = [[line for block in blocks for line in block]] if len(blocks) > 0 else []
+    return "".join("\t".join(block) + "\n" for block in blocks)
+
+
+# One output folder of _run_tokenizer: its shard writer, its checkpoint and the fragments already committed to it.
+# force, or different settings than the checkpoint, starts again from an empty out_folder.
+class _Output:
+    def __init__(self, out_folder, settings, force):
+        committed = None if force else _read_checkpoint(out_folder, settings)
+        if committed is None:
+            if os.path.exists(out_folder):
+                shutil.rmtree(out_folder)
+            os.makedirs(out_folder)
+            committed = []
+        self.level = settings["level"]
+        self.committed_files = set(record["file"] for record in committed)
+        self.writer = _resume_shards(out_folder, committed)
+        self.pending = []
+        # The checkpoint is rewritten once without the line a crash may have cut, then appended to. It is
+        # replaced atomically, so a crash while it is rewritten leaves the previous checkpoint.
+        checkpoint_path = os.path.join(out_folder, TOKENIZE_MANIFEST)
+        with open(checkpoint_path + ".tmp", "w") as checkpoint:
+            _write_records(checkpoint, [settings] + committed)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+        self.checkpoint = open(checkpoint_path, "a")
+
+    def write(self, file, text):
+        shard, end = self.writer.write(text)
+        self.pending.append({"file": file, "shard": shard, "end": end})
+
+    # The shards are flushed before the fragments written to them are recorded
+    def commit(self):
+        self.writer.flush()
+        _write_records(self.checkpoint, self.pending)
+        self.pending = []
+
+    def close(self):
+        self.writer.close()
+        self.checkpoint.close()
+
+
+# Tokenizes the files of folder_path into the shards of out_folder. A run that stopped before the end
+# continues after the last fragment it committed. derived lists (out_folder, level) pairs of 1d outputs
+# written from the same statement level tokenizer output (see _derive_1d), so the files are tokenized once.
+def _run_tokenizer(folder_path, out_folder, tokenizer_path, tokenizer_language, tokenizer_level,
+                   workers=TOKENIZER_WORKERS, executor=None, job_name=None, force=False, derived=(),
+                   slots=None):
+    outputs = [_Output(out_folder, {"language": tokenizer_language, "level": tokenizer_level}, force)]
+    for derived_folder, derived_level in derived:
+        outputs.append(_Output(derived_folder, {"language": tokenizer_language, "level": derived_level,
+                                                "derived_from": tokenizer_level}, force))
+    all_files = os.listdir(folder_path)
+    files = [file for file in all_files if any(file not in output.committed_files for output in outputs)]
+    input_files = [os.path.abspath(os.path.join(folder_path, file)) for file in files]
+    exe_path = os.path.abspath(tokenizer_path)
+    if job_name is None:
+        job_name = folder_path
+    if len(files) < len(all_files):
+        print("\t\t{0}: resuming after {1} tokenized files".format(job_name, len(all_files) - len(files)))
+    start = time.time()
+    texts = _tokenized_texts(input_files, exe_path, tokenizer_language, tokenizer_level, workers, executor, slots)
+    try:
+        for done, (file, tok_text) in enumerate(zip(files, texts), 1):
+            tok_text = tok_text.lstrip("b'").rstrip("'\\n")
+            for output in outputs:
+                if file in output.committed_files:
+                    continue
+                if output.level == tokenizer_level:
+                    output.write(file, tok_text)
+                else:
+                    output.write(file, _derive_1d(tok_text, output.level))
+            if done % TOKENIZE_BATCH == 0 or done == len(files):
+                for output in outputs:
+                    output.commit()
+                _report_progress(job_name, done, len(files), start)
+    finally:
+        for output in outputs:
+            output.close()
 
 
 def _get_max_length(tok_text):
@@ -70,8 +334,15 @@ def _get_max_length(tok_text):
     return max_length
 
 
-# tokenizer_language should be either "CSharp" or "Java"
-def tokenize(tokenizer_language, tokenizer_input_base_path, tokenizer_out_base_path, tokenizer_exe_path):
+# tokenizer_language should be either "CSharp" or "Java". All the (smell, dimension, label) jobs run at the
+# same time and share a pool of workers tokenizer processes; every job still writes its own shards in the
+# order of its input files. With workers=0 every file gets its own interpreter, and at most processes of
+# them (TOKENIZER_PROCESSES by default) run at the same time across the jobs.
+# Interrupted jobs resume from their checkpoint unless force is set. With single_pass and both dimensions
+# in dims, the 1d folders are written from the statement level output of the 2d jobs (see _derive_1d)
+# instead of tokenizing every fragment a second time.
+def tokenize(tokenizer_language, tokenizer_input_base_path, tokenizer_out_base_path, tokenizer_exe_path,
+             workers=TOKENIZER_WORKERS, force=False, dims=(2,), single_pass=False, processes=None):
     if not os.path.exists(tokenizer_out_base_path):
         os.makedirs(tokenizer_out_base_path)
 
@@ -79,7 +350,9 @@ def tokenize(tokenizer_language, tokenizer_input_base_path, tokenizer_out_base_p
     # list = ["ComplexConditional", "ComplexMethod", "MultifacetedAbstraction", "FeatureEnvy"]
     assert tokenizer_language == "CSharp" or tokenizer_language == "Java"
 
-    for dim in {2}:
+    jobs = []
+    derived = {}
+    for dim in sorted(dims, reverse=True):
         for dir in list:
             # default dimension is 1, so tokenizer level would be method
             tokenizer_level = "method"
@@ -89,18 +362,36 @@ def tokenize(tokenizer_language, tokenizer_input_base_path, tokenizer_out_base_p
             if dim == 2:
                 tokenizer_level = "statement"
                 dim_str = "2d"
-            print("Processing {0} smell for dimension {1}".format(dir, dim_str))
             cur_base_folder = os.path.join(tokenizer_input_base_path, dir, dir)
+            for label in ["Positive", "Negative"]:
+                cur_folder = os.path.join(cur_base_folder, label)
+                out_folder = os.path.join(os.path.join(os.path.join(tokenizer_out_base_path,
+                                                                    dir, dir), dim_str), label)
+                if single_pass and dim == 1 and 2 in dims:
+                    derived[(dir, label)].append((out_folder, tokenizer_level))
+                    continue
+                derived[(dir, label)] = []
+                jobs.append((cur_folder, out_folder, tokenizer_level, "{0} {1} {2}".format(dir, dim_str, label),
+                             derived[(dir, label)]))
 
-            print("\t processing positive cases...")
-            cur_folder = os.path.join(cur_base_folder, "Positive")
-            out_folder = os.path.join(os.path.join(os.path.join(tokenizer_out_base_path,
-                                                                dir, dir), dim_str), "Positive")
-            _run_tokenizer(cur_folder, out_folder, tokenizer_exe_path, tokenizer_language, tokenizer_level)
-
-            print("\t processing negative training cases...")
-            cur_folder = os.path.join(cur_base_folder, "Negative")
-            out_folder = os.path.join(os.path.join(os.path.join(tokenizer_out_base_path,
-                                                                dir, dir), dim_str), "Negative")
-            _run_tokenizer(cur_folder, out_folder, tokenizer_exe_path, tokenizer_language, tokenizer_level)
+    print("Tokenizing {0} jobs".format(len(jobs)))
+    if len(jobs) == 0:
+        return
+    executor = None
+    slots = None
+    if workers == 0:
+        slots = threading.Semaphore(TOKENIZER_PROCESSES if processes is None else processes)
+    else:
+        executor = _tokenizer_pool(os.path.abspath(tokenizer_exe_path), workers)
+    try:
+        with ThreadPoolExecutor(max_workers=len(jobs)) as job_threads:
+            futures = [job_threads.submit(_run_tokenizer, cur_folder, out_folder, tokenizer_exe_path,
+                                          tokenizer_language, tokenizer_level, workers, executor, job_name, force,
+                                          job_derived, slots)
+                       for cur_folder, out_folder, tokenizer_level, job_name, job_derived in jobs]
+            for future in futures:
+                future.result()
+    finally:
+        if executor is not None:
+            executor.shutdown()
     print("Tokenizing done.")
@@ -8,6 +8,7 @@ from tensorflow.python.keras import regularizers
 
 import input_data
 import inputs
+import data_sequence
 import time
 import datetime
 import numpy as np
@@ -27,11 +28,49 @@ OUT_FOLDER = "/users/pa18/tushar/smellDetectionML/learning_smells/results/rq1/ra
 # TOKENIZER_OUT_PATH = r"..\..\data\tokenizer_out"
 # OUT_FOLDER = r"..\results\rq1\raw"
 TRAIN_VALIDATE_RATIO = 0.7
+STREAMING = False # Read the batches lazily from the token store (data_sequence.py) instead of loading all samples in memory
 
 
 # --
 
 
+def _train_size(data):
+    if isinstance(data.train_data, data_sequence.SampleSequence):
+        return data.train_data.sample_count()
+    return len(data.train_data)
+
+
+def _fit(autoencoder, data, epochs, batch_size, val_split):
+    if isinstance(data.train_data, data_sequence.SampleSequence):
+        return data_sequence.fit(autoencoder, data.train_data, epochs, batch_size, validation_split=val_split).history
+    return autoencoder.fit(data.train_data,
+                           data.train_data,
+                           epochs=epochs,
+                           batch_size=batch_size,
+                           verbose=1,
+                           validation_split=val_split,
+                           shuffle=True).history
+
+
+def _reconstruction_error(autoencoder, data):
+    if isinstance(data.eval_data, data_sequence.SampleSequence):
+        return data_sequence.reconstruction_error(autoencoder, data.eval_data)
+    predictions = autoencoder.predict(data.eval_data)
+    predictions = predictions.reshape(predictions.shape[0], predictions.shape[1])
+    data.eval_data = data.eval_data.reshape(data.eval_data.shape[0], data.eval_data.shape[1])
+    return np.mean(np.power(data.eval_data - predictions, 2), axis=1)
+
+
+# The conv and lstm autoencoders take (samples, length, 1) inputs
+def _add_channel(data):
+    if isinstance(data.train_data, data_sequence.SampleSequence):
+        data.train_data.channel = True
+        data.eval_data.channel = True
+    else:
+        data.train_data = data.train_data.reshape((len(data.train_data), data.max_input_length, 1))
+        data.eval_data = data.eval_data.reshape((len(data.eval_labels), data.max_input_length, 1))
+
+
 def autoencoder_dense(data, smell, layers=1, encoding_dimension=32, epochs=10, with_bottleneck=True, is_final=False, threshold=400000):
     encoding_dim = encoding_dimension
     input_layer = Input(shape=(data.max_input_length,))
@@ -57,21 +96,14 @@ def autoencoder_dense(data, smell, layers=1, encoding_dimension=32, epochs=10, w
 
     batch_sizes = [32, 64, 128]
     # batch_sizes = [32, 64, 128, 256, 512]
-    b_size = int(len(data.train_data) / batch_sizes[len(batch_sizes) - 1])
+    b_size = int(_train_size(data) / batch_sizes[len(batch_sizes) - 1])
     if b_size > len(batch_sizes) - 1:
         b_size = len(batch_sizes) - 1
 
     val_split = 0.2
     if is_final:
         val_split = 0
-    history = autoencoder.fit(data.train_data,
-                              data.train_data,
-                              epochs=epochs,
-                              # batch_size=batch_size,
-                              batch_size=batch_sizes[b_size],
-                              verbose=1,
-                              validation_split=val_split,
-                              shuffle=True).history
+    history = _fit(autoencoder, data, epochs, batch_sizes[b_size], val_split)
 
     # plt.plot(history['loss'])
     # plt.plot(history['val_loss'])
@@ -81,8 +113,7 @@ def autoencoder_dense(data, smell, layers=1, encoding_dimension=32, epochs=10, w
     # plt.legend(['train', 'test'], loc='upper right')
     # plt.show()
 
-    predictions = autoencoder.predict(data.eval_data)
-    mse = np.mean(np.power(data.eval_data - predictions, 2), axis=1)
+    mse = _reconstruction_error(autoencoder, data)
     error_df = pd.DataFrame({'Reconstruction_error': mse,
                              'True_class': data.eval_labels})
     # print(error_df.describe())
@@ -93,8 +124,7 @@ def autoencoder_dense(data, smell, layers=1, encoding_dimension=32, epochs=10, w
 
 
 def autoencoder_cnn(data, config):
-    data.train_data = data.train_data.reshape((len(data.train_data), data.max_input_length, 1))
-    data.eval_data = data.eval_data.reshape((len(data.eval_labels), data.max_input_length, 1))
+    _add_channel(data)
     # print("train_data shape: " + str(data.train_data.shape))
 
     input_layer = Input(shape=(data.max_input_length, 1))
@@ -128,17 +158,10 @@ def autoencoder_cnn(data, config):
 
     # batch_sizes = [32, 64, 128]
     batch_sizes = [32, 64, 128, 256, 512]
-    b_size = int(len(data.train_data) / batch_sizes[len(batch_sizes) - 1])
+    b_size = int(_train_size(data) / batch_sizes[len(batch_sizes) - 1])
     if b_size > len(batch_sizes) - 1:
         b_size = len(batch_sizes) - 1
-    history = autoencoder.fit(data.train_data,
-                              data.train_data,
-                              epochs=config.epochs,
-                              # batch_size=batch_size,
-                              batch_size=batch_sizes[b_size],
-                              verbose=1,
-                              validation_split=0.2,
-                              shuffle=True).history
+    history = _fit(autoencoder, data, config.epochs, batch_sizes[b_size], 0.2)
 
     # plt.plot(history['loss'])
     # plt.plot(history['val_loss'])
@@ -148,10 +171,7 @@ def autoencoder_cnn(data, config):
     # plt.legend(['train', 'test'], loc='upper right')
     # plt.show()
 
-    predictions = autoencoder.predict(data.eval_data)
-    predictions = predictions.reshape(predictions.shape[0], predictions.shape[1])
-    data.eval_data = data.eval_data.reshape(data.eval_data.shape[0], data.eval_data.shape[1])
-    mse = np.mean(np.power(data.eval_data - predictions, 2), axis=1)
+    mse = _reconstruction_error(autoencoder, data)
     error_df = pd.DataFrame({'Reconstruction_error': mse,
                              'True_class': data.eval_labels})
     # print(error_df.describe())
@@ -186,8 +206,7 @@ def find_optimal(error_df):
 
 def autoencoder_lstm(data, smell, layers=1, encoding_dimension=8, no_of_epochs=10, with_bottleneck=True,
                      is_final=False):
-    data.train_data = data.train_data.reshape((len(data.train_data), data.max_input_length, 1))
-    data.eval_data = data.eval_data.reshape((len(data.eval_labels), data.max_input_length, 1))
+    _add_channel(data)
 
     encoding_dim = encoding_dimension
     input_layer = Input(shape=(data.max_input_length, 1))
@@ -225,16 +244,10 @@ def autoencoder_lstm(data, smell, layers=1, encoding_dimension=8, no_of_epochs=1
 
     # batch_sizes = [32, 64, 128, 256, 512]
     batch_sizes = [32, 64]
-    b_size = int(len(data.train_data) / 512)
+    b_size = int(_train_size(data) / 512)
     if b_size > len(batch_sizes) - 1:
         b_size = len(batch_sizes) - 1
-    history = autoencoder.fit(data.train_data,
-                              data.train_data,
-                              epochs=no_of_epochs,
-                              batch_size=batch_sizes[b_size],
-                              verbose=1,
-                              validation_split=0.2,
-                              shuffle=True).history
+    history = _fit(autoencoder, data, no_of_epochs, batch_sizes[b_size], 0.2)
 
     # plt.plot(history['loss'])
     # plt.plot(history['val_loss'])
@@ -244,10 +257,7 @@ def autoencoder_lstm(data, smell, layers=1, encoding_dimension=8, no_of_epochs=1
     # plt.legend(['train', 'test'], loc='upper right')
     # plt.show()
 
-    predictions = autoencoder.predict(data.eval_data)
-    predictions = predictions.reshape(predictions.shape[0], predictions.shape[1])
-    data.eval_data = data.eval_data.reshape(data.eval_data.shape[0], data.eval_data.shape[1])
-    mse = np.mean(np.power(data.eval_data - predictions, 2), axis=1)
+    mse = _reconstruction_error(autoencoder, data)
     error_df = pd.DataFrame({'Reconstruction_error': mse,
                              'True_class': data.eval_labels})
     print(error_df.describe())
@@ -268,6 +278,17 @@ def get_all_data(data_path, smell):
     if smell in ["MultifacetedAbstraction", "FeatureEnvy"]:
         max_eval_samples = 50000
 
+    if STREAMING:
+        train_data, eval_data, max_input_length = \
+            data_sequence.get_data_autoencoder_sequences(data_path,
+                                                         train_validate_ratio=TRAIN_VALIDATE_RATIO,
+                                                         max_training_samples=5000,
+                                                         max_eval_samples=max_eval_samples)
+        print("train_data: " + str(train_data.sample_count()))
+        print("eval_data: " + str(eval_data.sample_count()))
+        print("reading data... done.")
+        return input_data.Input_data(train_data, None, eval_data, eval_data.labels, max_input_length)
+
     train_data, eval_data, eval_labels, max_input_length = \
         inputs.get_data_autoencoder(data_path,
                                     train_validate_ratio=TRAIN_VALIDATE_RATIO,
@@ -9,6 +9,7 @@ OUT_FOLDER = "/users/pa18/tushar/smellDetectionML/learning_smells/results/rq1/ra
 smell_list = ["MultifacetedAbstraction"]
 DIM = "1d"
 
-for smell in smell_list:
-    data_path = os.path.join(TOKENIZER_OUT_PATH, smell, DIM)
-    autoencoder.main_lstm(smell, data_path, skip_iter=5)
\ No newline at end of file
+if __name__ == "__main__":
+    for smell in smell_list:
+        data_path = os.path.join(TOKENIZER_OUT_PATH, smell, DIM)
+        autoencoder.main_lstm(smell, data_path, skip_iter=5)
\ No newline at end of file
@@ -0,0 +1,67 @@
+import os
+import manifest
+import token_store
+
+# Size statistics of the text shards of a folder: the size in bytes, lines, empty lines (the 2d sample separators),
+# tokens and longest line (in characters) of every shard. They are cached in a hidden file inside the folder
+# with the size and modification time of each shard, so only new or changed shards are read again; the
+# sample counts and input sizes of inputs.py are then answered without reading the folder.
+STATS_FILE = ".corpus_stats.json"
+# Cached entries of another version are read again; it changes with the way the statistics are counted
+STATS_VERSION = 2
+
+
+# Counted like the former helpers of inputs.py did on the whole text decoded as utf8: an empty line has no
+# tokens. binary_lines are split on "\n" alone, like the binary readlines() of item_line_count.
+def _shard_stats(path):
+    stats = {"lines": 0, "binary_lines": 0, "empty_lines": 0, "tokens": 0, "max_line_chars": 0,
+             "version": STATS_VERSION}
+    with open(path, "rb") as reader:
+        for _ in reader:
+            stats["binary_lines"] += 1
+    with open(path, "r", encoding="utf8", errors='ignore') as reader:
+        for line in reader:
+            stats["lines"] += 1
+            if len(line) < 2:
+                stats["empty_lines"] += 1
+            if len(line) > stats["max_line_chars"]:
+                stats["max_line_chars"] = len(line)
+            if line.strip() != "":
+                stats["tokens"] += len(token_store.parse_line(line))
+    return stats
+
+
+# {shard: stats} for the shards of the folder, from the cache where the size and modification time still match
+def folder_stats(folder):
+    path = os.path.join(folder, STATS_FILE)
+    cached = manifest.read_json(path) or {}
+    shards = {}
+    changed = []
+    for name, size, mtime in token_store.folder_signature(folder):
+        entry = cached.get(name)
+        if entry is not None and entry["size"] == size and entry["mtime"] == mtime and \
+                entry.get("version") == STATS_VERSION:
+            shards[name] = entry
+        else:
+            changed.append((name, size, mtime))
+    if len(changed) == 0 and len(shards) == len(cached):
+        return shards
+    paths = [os.path.join(folder, name) for name, _, _ in changed]
+    for (name, size, mtime), stats in zip(changed, token_store.iter_shards(_shard_stats, paths)):
+        stats["size"] = size
+        stats["mtime"] = mtime
+        shards[name] = stats
+    try:
+        manifest.write_json(path, shards)
+    except OSError:
+        # A read only folder just means the changed shards are read again next time
+        pass
+    return shards
+
+
+def total(folder, key):
+    return sum(stats[key] for stats in folder_stats(folder).values())
+
+
+def maximum(folder, key):
+    return max([stats[key] for stats in folder_stats(folder).values()] + [0])
@@ -0,0 +1,322 @@
+import copy
+import math
+import numpy as np
+import tensorflow as tf
+import inputs
+import token_store
+
+# Streaming input for the trainers: instead of materializing the whole float32 train/eval arrays,
+# a SampleSequence keeps only sample indices and reads each batch lazily from the memory mapped
+# token store (see token_store.py); keras prefetches the batches in background workers.
+PREFETCH_BATCHES = 10
+PREFETCH_WORKERS = 2
+
+# The 2d batches are padded to the largest sample of the batch rounded up to a multiple of PAD_MULTIPLE,
+# which bounds the number of distinct batch shapes (and so of retraced keras functions)
+PAD_MULTIPLE = 8
+
+# Number of batches whose samples are sorted by length together by BucketedSampleSequence; larger buckets
+# waste less padding, smaller ones keep the batches more random
+BUCKET_BATCHES = 50
+
+
+class SampleSequence(tf.keras.utils.Sequence):
+    # sources is a list of ((values, offsets), sample indices, label) tuples, like for inputs._assemble.
+    # channel adds the trailing dimension the Conv1D models expect; autoencoder yields (x, x) batches.
+    def __init__(self, sources, max_len, batch_size=32, shuffle=False, seed=inputs.RANDOM_SEED, channel=True,
+                 autoencoder=False, dtype=np.float32, table=None):
+        self.samples = [samples for samples, _, _ in sources]
+        self.source_ids = np.concatenate([np.full(len(indices), i, dtype=np.int32)
+                                          for i, (_, indices, _) in enumerate(sources)])
+        self.sample_ids = np.concatenate([np.asarray(indices, dtype=np.int64) for _, indices, _ in sources])
+        self.sample_labels = np.concatenate([np.full(len(indices), label, dtype=np.float32)
+                                             for _, indices, label in sources])
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.channel = channel
+        self.autoencoder = autoencoder
+        self.dtype = dtype
+        # Vocabulary lookup table applied to the token ids (see inputs.data_encoding)
+        self.table = table
+        self.rng = np.random.RandomState(seed)
+        # Shuffling only permutes this index array, so it never holds more than 8 bytes per sample in memory
+        self.order = self.rng.permutation(len(self.sample_labels))
+
+    def __len__(self):
+        return int(math.ceil(len(self.order) / float(self.batch_size)))
+
+    def __getitem__(self, index):
+        refs = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        x = np.zeros((len(refs), self.max_len), dtype=self.dtype)
+        ref_sources = self.source_ids[refs]
+        for source_id in np.unique(ref_sources):
+            out_rows = np.flatnonzero(ref_sources == source_id)
+            values, offsets = self.samples[source_id]
+            token_store.pad_samples_into(values, offsets, self.sample_ids[refs[out_rows]], x, out_rows, self.table)
+        if self.channel:
+            x = x.reshape((len(refs), self.max_len, 1))
+        if self.autoencoder:
+            return x, x
+        return x, self.sample_labels[refs]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
+    def sample_count(self):
+        return len(self.order)
+
+    # Labels in the order the batches are produced (stable as long as shuffle is off)
+    @property
+    def labels(self):
+        return self.sample_labels[self.order]
+
+    # Like validation_split of model.fit, the last part of the samples is held out for validation
+    def split(self, validation_split):
+        total_train = len(self.order) - int(len(self.order) * validation_split)
+        return self._subset(self.order[:total_train], self.shuffle), self._subset(self.order[total_train:], False)
+
+    def max_value(self):
+        if self.table is not None:
+            return int(np.max(self.table))
+        return max(int(np.max(values)) for values, _ in self.samples if len(values) > 0)
+
+    def _subset(self, refs, shuffle):
+        subset = copy.copy(self)
+        subset.order = np.array(refs)
+        subset.shuffle = shuffle
+        subset.rng = np.random.RandomState(self.rng.randint(2 ** 31 - 1))
+        return subset
+
+
+class BucketedSampleSequence(SampleSequence):
+    # Groups samples of similar length: every BUCKET_BATCHES batches worth of samples are sorted by length and
+    # cut into batches, so each batch is padded only to its longest sample instead of max_len.
+    # It yields (samples, length) batches for the Embedding models; with shuffle, the samples are redistributed
+    # over the buckets and the batch order is shuffled every epoch.
+    def __init__(self, sources, max_len, batch_size=32, shuffle=False, seed=inputs.RANDOM_SEED, dtype=np.float32,
+                 table=None):
+        super(BucketedSampleSequence, self).__init__(sources, max_len, batch_size=batch_size, shuffle=shuffle,
+                                                     seed=seed, channel=False, dtype=dtype, table=table)
+        self.lengths = np.concatenate([token_store.sample_lengths(offsets)[np.asarray(indices, dtype=np.int64)]
+                                       for (_, offsets), indices, _ in sources])
+        self.samples_order = self.order
+        self._arrange()
+
+    def _arrange(self):
+        bucket_size = self.batch_size * BUCKET_BATCHES
+        self.batches = []
+        for start in range(0, len(self.samples_order), bucket_size):
+            refs = self.samples_order[start:start + bucket_size]
+            refs = refs[np.argsort(self.lengths[refs], kind='stable')]
+            self.batches.extend(refs[i:i + self.batch_size] for i in range(0, len(refs), self.batch_size))
+        if self.shuffle:
+            self.rng.shuffle(self.batches)
+        self.order = np.concatenate(self.batches) if len(self.batches) > 0 else self.samples_order
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        refs = self.batches[index]
+        width = min(_round_up(int(np.max(self.lengths[refs]))), self.max_len)
+        x = np.zeros((len(refs), max(width, 1)), dtype=self.dtype)
+        ref_sources = self.source_ids[refs]
+        for source_id in np.unique(ref_sources):
+            out_rows = np.flatnonzero(ref_sources == source_id)
+            values, offsets = self.samples[source_id]
+            token_store.pad_samples_into(values, offsets, self.sample_ids[refs[out_rows]], x, out_rows, self.table)
+        return x, self.sample_labels[refs]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.samples_order)
+            self._arrange()
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+        self._arrange()
+
+    def sample_count(self):
+        return len(self.samples_order)
+
+    # The validation samples are held out before bucketing, so they are not biased towards any length
+    def split(self, validation_split):
+        total_train = len(self.samples_order) - int(len(self.samples_order) * validation_split)
+        return self._subset(self.samples_order[:total_train], self.shuffle), \
+               self._subset(self.samples_order[total_train:], False)
+
+    def _subset(self, refs, shuffle):
+        subset = super(BucketedSampleSequence, self)._subset(refs, shuffle)
+        subset.samples_order = subset.order
+        subset._arrange()
+        return subset
+
+
+class Sample2dSequence(SampleSequence):
+    # sources is a list of ((values, line offsets, sample offsets), sample indices, label) tuples, like for
+    # inputs._assemble_2d. Each batch is padded only up to its own largest sample (at most max_height lines
+    # and max_width tokens per line, at least min_height x min_width for the convolutions of the model).
+    def __init__(self, sources, max_height, max_width, batch_size=32, shuffle=False, seed=inputs.RANDOM_SEED):
+        super(Sample2dSequence, self).__init__(sources, max_height, batch_size=batch_size, shuffle=shuffle,
+                                               seed=seed)
+        self.max_width = max_width
+        self.min_height = 1
+        self.min_width = 1
+        self.heights = []
+        self.widths = []
+        for values, line_offsets, sample_offsets in self.samples:
+            self.heights.append(token_store.sample_lengths(sample_offsets))
+            self.widths.append(_longest_lines(line_offsets, sample_offsets))
+
+    def __getitem__(self, index):
+        refs = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        ref_sources = self.source_ids[refs]
+        height = 0
+        width = 0
+        for source_id in np.unique(ref_sources):
+            samples = self.sample_ids[refs[ref_sources == source_id]]
+            height = max(height, int(np.max(self.heights[source_id][samples])))
+            width = max(width, int(np.max(self.widths[source_id][samples])))
+        height = max(_round_up(min(height, self.max_len)), self.min_height)
+        width = max(_round_up(min(width, self.max_width)), self.min_width)
+
+        x = np.zeros((len(refs), height, width), dtype=np.float32)
+        for source_id in np.unique(ref_sources):
+            out_rows = np.flatnonzero(ref_sources == source_id)
+            values, line_offsets, sample_offsets = self.samples[source_id]
+            token_store.pad_samples_2d_into(values, line_offsets, sample_offsets, self.sample_ids[refs[out_rows]],
+                                            x, out_rows)
+        return x.reshape((len(refs), height, width, 1)), self.sample_labels[refs]
+
+    def max_value(self):
+        return max(int(np.max(values)) for values, _, _ in self.samples if len(values) > 0)
+
+
+def _round_up(size):
+    return int(math.ceil(size / float(PAD_MULTIPLE))) * PAD_MULTIPLE
+
+
+# Number of tokens of the longest line of every sample
+def _longest_lines(line_offsets, sample_offsets):
+    widths = np.zeros(len(sample_offsets) - 1, dtype=np.int64)
+    non_empty = np.flatnonzero(np.diff(sample_offsets) > 0)
+    if len(non_empty) > 0:
+        widths[non_empty] = np.maximum.reduceat(token_store.sample_lengths(line_offsets),
+                                                sample_offsets[non_empty])
+    return widths
+
+
+def fit(model, sequence, epochs, batch_size, validation_split=0.0, callbacks=None, verbose=1):
+    sequence.set_batch_size(batch_size)
+    validation_data = None
+    if validation_split > 0:
+        sequence, validation_data = sequence.split(validation_split)
+    return model.fit(sequence, validation_data=validation_data, epochs=epochs, callbacks=callbacks,
+                     verbose=verbose, shuffle=False, max_queue_size=PREFETCH_BATCHES, workers=PREFETCH_WORKERS)
+
+
+# Mean squared reconstruction error per sample, computed batch by batch so that neither the
+# evaluation data nor the predictions are held in memory at once
+def reconstruction_error(model, sequence):
+    errors = []
+    for index in range(len(sequence)):
+        x = sequence[index][0]
+        predictions = model.predict_on_batch(x).reshape(x.shape)
+        errors.append(np.mean(np.power(x - predictions, 2), axis=1).reshape(-1))
+    return np.concatenate(errors)
+
+
+# The stores are built when missing, so that the sequences read the samples lazily from disk
+def _ensure_stores(*data_paths, is_c2v=False, dimension=1):
+    for data_path in data_paths:
+        inputs.build_token_store(data_path, is_c2v=is_c2v, dimension=dimension)
+
+
+def _bucketed_sequences(training_sources, eval_sources, max_input_length, shuffle, dtype, table, rng):
+    return BucketedSampleSequence(training_sources, max_input_length, shuffle=shuffle, seed=rng.randint(2 ** 31 - 1),
+                                  dtype=dtype, table=table), \
+           BucketedSampleSequence(eval_sources, max_input_length, seed=rng.randint(2 ** 31 - 1), dtype=dtype,
+                                  table=table), \
+           max_input_length
+
+
+# bucket_by_length returns BucketedSampleSequences (2d batches without the channel dimension);
+# vocab_size keeps only the most frequent token ids (see inputs.data_encoding)
+def get_data_sequences(data_path, train_validate_ratio=0.7, max_training_samples=5000, max_eval_samples=150000,
+                       is_c2v=False, shuffle=False, channel=True, seed=inputs.RANDOM_SEED, token_ids=False,
+                       bucket_by_length=False, vocab_size=None):
+    _ensure_stores(data_path, is_c2v=is_c2v)
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_length = \
+        inputs._split_data(data_path, train_validate_ratio, max_training_samples, max_eval_samples, is_c2v, rng)
+    dtype, table = inputs.data_encoding(data_path, training_sources + eval_sources, token_ids and not is_c2v,
+                                        vocab_size, inputs.manifest.label_folders(data_path))
+    if bucket_by_length:
+        return _bucketed_sequences(training_sources, eval_sources, max_input_length, shuffle, dtype, table, rng)
+    return SampleSequence(training_sources, max_input_length, shuffle=shuffle, seed=rng.randint(2 ** 31 - 1),
+                          channel=channel, dtype=dtype, table=table), \
+           SampleSequence(eval_sources, max_input_length, seed=rng.randint(2 ** 31 - 1), channel=channel,
+                          dtype=dtype, table=table), \
+           max_input_length
+
+
+def get_data_rq2_sequences(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio=0.7,
+                           max_training_samples=5000, max_eval_samples=150000, shuffle=False, channel=True,
+                           seed=inputs.RANDOM_SEED, token_ids=False, bucket_by_length=False, vocab_size=None):
+    _ensure_stores(training_data_path, eval_data_path)
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_length = \
+        inputs._split_data_rq2(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio,
+                               max_training_samples, max_eval_samples, rng)
+    dtype, table = inputs.data_encoding(training_data_path, training_sources + eval_sources, token_ids, vocab_size,
+                                        inputs.manifest.label_folders(training_data_path)
+                                        + inputs.manifest.label_folders(eval_data_path))
+    if bucket_by_length:
+        return _bucketed_sequences(training_sources, eval_sources, max_input_length, shuffle, dtype, table, rng)
+    return SampleSequence(training_sources, max_input_length, shuffle=shuffle, seed=rng.randint(2 ** 31 - 1),
+                          channel=channel, dtype=dtype, table=table), \
+           SampleSequence(eval_sources, max_input_length, seed=rng.randint(2 ** 31 - 1), channel=channel,
+                          dtype=dtype, table=table), \
+           max_input_length
+
+
+def get_data_autoencoder_sequences(data_path, train_validate_ratio=0.7, max_training_samples=5000,
+                                   max_eval_samples=150000, seed=inputs.RANDOM_SEED):
+    _ensure_stores(data_path)
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_length = \
+        inputs._split_data_autoencoder(data_path, train_validate_ratio, max_training_samples, max_eval_samples, rng)
+    return SampleSequence(training_sources, max_input_length, shuffle=True, seed=rng.randint(2 ** 31 - 1),
+                          channel=False, autoencoder=True), \
+           SampleSequence(eval_sources, max_input_length, seed=rng.randint(2 ** 31 - 1), channel=False), \
+           max_input_length
+
+
+def get_data_2d_sequences(data_path, out_folder, case_string, train_validate_ratio=0.7, max_training_samples=5000,
+                          shuffle=False, seed=inputs.RANDOM_SEED):
+    _ensure_stores(data_path, dimension=2)
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_height, max_input_width = \
+        inputs._split_data_2d(data_path, out_folder, case_string, train_validate_ratio, max_training_samples, rng)
+    return Sample2dSequence(training_sources, max_input_height, max_input_width, shuffle=shuffle,
+                            seed=rng.randint(2 ** 31 - 1)), \
+           Sample2dSequence(eval_sources, max_input_height, max_input_width, seed=rng.randint(2 ** 31 - 1)), \
+           max_input_height, max_input_width
+
+
+def get_data_2d_rq2_sequences(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio=0.7,
+                              max_training_samples=5000, shuffle=False, seed=inputs.RANDOM_SEED):
+    _ensure_stores(training_data_path, eval_data_path, dimension=2)
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_height, max_input_width = \
+        inputs._split_data_2d_rq2(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio,
+                                  max_training_samples, rng)
+    return Sample2dSequence(training_sources, max_input_height, max_input_width, shuffle=shuffle,
+                            seed=rng.randint(2 ** 31 - 1)), \
+           Sample2dSequence(eval_sources, max_input_height, max_input_width, seed=rng.randint(2 ** 31 - 1)), \
+           max_input_height, max_input_width
@@ -0,0 +1,217 @@
+import hashlib
+import os
+import sqlite3
+import manifest
+
+# Corpus wide deduplication of the tokenizer output. A sample (a line in 1d, a block of lines up to an
+# empty line in 2d) is identified by a blake2b fingerprint of DIGEST_SIZE bytes instead of its text, and
+# is kept only the first time it shows up in any shard of its label folder. Samples present in both
+# Positive and Negative are reported as conflicts.
+DIGEST_SIZE = 8  # 16 for 128 bit fingerprints
+# Number of fingerprints kept in memory per label; beyond it they spill to an on-disk sqlite set
+MAX_MEMORY_FINGERPRINTS = 5000000
+CONFLICTS_FILE = "dedupe_conflicts.txt"
+# Processed shards get this suffix; they are not deduplicated again but their samples are still seen
+PROCESSED_SUFFIX = ".cld"
+TEMP_FILE = ".dedupe.tmp"
+# The fingerprints of the samples of every processed shard are kept in a hidden sidecar file
+# ("." + shard + ".fp" + digest size), so later runs load them instead of reading the shard again
+FINGERPRINTS_SUFFIX = ".fp"
+
+
+def fingerprint(sample, digest_size=DIGEST_SIZE):
+    return hashlib.blake2b(sample.encode("utf-8", "surrogateescape"), digest_size=digest_size).digest()
+
+
+class FingerprintSet:
+    def __init__(self, spill_path, max_memory_fingerprints=MAX_MEMORY_FINGERPRINTS):
+        self.spill_path = spill_path
+        self.max_memory_fingerprints = max_memory_fingerprints
+        self.fingerprints = set()
+        self.db = None
+        self.count = 0
+
+    def _spill(self):
+        if os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+        self.db = sqlite3.connect(self.spill_path)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE fingerprints (fp BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.db.executemany("INSERT INTO fingerprints VALUES (?)", ((fp,) for fp in self.fingerprints))
+        self.fingerprints = set()
+
+    # Returns False when the fingerprint was already in the set
+    def add(self, fp):
+        if self.db is not None:
+            added = self.db.execute("INSERT OR IGNORE INTO fingerprints VALUES (?)", (fp,)).rowcount == 1
+        else:
+            added = fp not in self.fingerprints
+            if added:
+                self.fingerprints.add(fp)
+                if len(self.fingerprints) > self.max_memory_fingerprints:
+                    self._spill()
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, fp):
+        if self.db is not None:
+            return self.db.execute("SELECT 1 FROM fingerprints WHERE fp = ?", (fp,)).fetchone() is not None
+        return fp in self.fingerprints
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.fingerprints = set()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            os.remove(self.spill_path)
+
+
+def samples_1d(filepath):
+    with open(filepath, errors='ignore') as f:
+        for line in f:
+            yield line.rstrip("\n")
+
+
+# The samples of a shard as (fingerprint, parts) pairs, where the sample text is "".join(parts).
+# A 2d sample is hashed line by line as it is read, so a long method is never concatenated into one string;
+# the fingerprint is the one fingerprint gives for the sample text. As in the former remove_duplicates_2d,
+# a block without an empty line after it is not a sample.
+def fingerprinted_samples_2d(filepath, digest_size=DIGEST_SIZE):
+    with open(filepath, errors='ignore') as f:
+        digest = hashlib.blake2b(digest_size=digest_size)
+        lines = []
+        for line in f:
+            if len(line) > 1:
+                digest.update(line.encode("utf-8", "surrogateescape"))
+                lines.append(line)
+            else:
+                yield digest.digest(), lines
+                digest = hashlib.blake2b(digest_size=digest_size)
+                lines = []
+
+
+def fingerprinted_samples_1d(filepath, digest_size=DIGEST_SIZE):
+    for sample in samples_1d(filepath):
+        yield fingerprint(sample, digest_size), [sample]
+
+
+def fingerprinted_samples(dimension):
+    return fingerprinted_samples_2d if dimension == 2 else fingerprinted_samples_1d
+
+
+def _sidecar(folder, shard, digest_size):
+    return os.path.join(folder, "." + shard + FINGERPRINTS_SUFFIX + str(digest_size))
+
+
+def _write_sidecar(path, fingerprints):
+    with open(path + manifest.TEMP_SUFFIX, "wb") as writer:
+        writer.write(b"".join(fingerprints))
+    os.replace(path + manifest.TEMP_SUFFIX, path)
+
+
+# Fingerprints of a processed shard: from its sidecar when it is newer than the shard, otherwise
+# from the shard itself (and the sidecar is rewritten)
+def _processed_fingerprints(folder, shard, dimension, digest_size):
+    filepath = os.path.join(folder, shard)
+    sidecar = _sidecar(folder, shard, digest_size)
+    if os.path.isfile(sidecar) and os.stat(sidecar).st_mtime_ns >= os.stat(filepath).st_mtime_ns:
+        with open(sidecar, "rb") as reader:
+            data = reader.read()
+        if len(data) % digest_size == 0:
+            return [data[i:i + digest_size] for i in range(0, len(data), digest_size)]
+    fingerprints = [fp for fp, _ in fingerprinted_samples(dimension)(filepath, digest_size)]
+    _write_sidecar(sidecar, fingerprints)
+    return fingerprints
+
+
+def _remove_orphan_sidecars(folder):
+    shards = set(manifest.shard_files(folder))
+    for f in os.listdir(folder):
+        if f.startswith(".") and FINGERPRINTS_SUFFIX in f and f[1:f.rfind(FINGERPRINTS_SUFFIX)] not in shards:
+            os.remove(os.path.join(folder, f))
+
+
+# Deduplicates one label folder across all its shards. Unprocessed shards are rewritten without the samples
+# seen before and renamed with PROCESSED_SUFFIX. Returns the number of unique samples and of duplicates removed.
+def dedupe_folder(folder, dimension=1, digest_size=DIGEST_SIZE, max_memory_fingerprints=MAX_MEMORY_FINGERPRINTS):
+    read_samples = fingerprinted_samples(dimension)
+    seen = FingerprintSet(os.path.join(folder, ".dedupe.sqlite"), max_memory_fingerprints)
+    duplicates = 0
+    try:
+        shards = manifest.shard_files(folder)
+        # In the order of their processed names, which is the order of the samples in the token store
+        pending = sorted((f for f in shards if not f.endswith(PROCESSED_SUFFIX)), key=lambda f: f + PROCESSED_SUFFIX)
+        # The samples of already processed shards are unique; they only need to be known.
+        # A processed shard whose source is still there comes from an interrupted run and is redone.
+        for shard in [f for f in shards if f.endswith(PROCESSED_SUFFIX)]:
+            if shard[:-len(PROCESSED_SUFFIX)] in pending:
+                continue
+            for fp in _processed_fingerprints(folder, shard, dimension, digest_size):
+                seen.add(fp)
+        for shard in pending:
+            filepath = os.path.join(folder, shard)
+            outfilepath = os.path.join(folder, TEMP_FILE)
+            kept = []
+            with open(outfilepath, "w") as filewriter:
+                for fp, parts in read_samples(filepath, digest_size):
+                    if not seen.add(fp):
+                        duplicates += 1
+                        continue
+                    kept.append(fp)
+                    # In 2d the sample ends with a line break, so this writes the empty separator line
+                    filewriter.writelines(parts)
+                    filewriter.write("\n")
+            # The source is removed only once its output is in place
+            _write_sidecar(_sidecar(folder, shard + PROCESSED_SUFFIX, digest_size), kept)
+            os.replace(outfilepath, filepath + PROCESSED_SUFFIX)
+            os.remove(filepath)
+        _remove_orphan_sidecars(folder)
+        unique = len(seen)
+    finally:
+        seen.close()
+    print("\t" + folder + ": " + str(unique) + " unique samples, " + str(duplicates) + " duplicates removed")
+    return unique, duplicates
+
+
+# Writes the fingerprints of the samples found in more than one of the deduplicated folders to
+# CONFLICTS_FILE in path, from the fingerprint sidecars of their shards. Returns their number.
+def find_conflicts(path, folders, dimension=1, digest_size=DIGEST_SIZE,
+                   max_memory_fingerprints=MAX_MEMORY_FINGERPRINTS):
+    label_sets = []
+    conflicts = set()
+    try:
+        for folder in folders:
+            seen = FingerprintSet(os.path.join(folder, ".dedupe.sqlite"), max_memory_fingerprints)
+            label_sets.append(seen)
+            other_sets = label_sets[:-1]
+            for shard in manifest.shard_files(folder):
+                for fp in _processed_fingerprints(folder, shard, dimension, digest_size):
+                    seen.add(fp)
+                    if any(fp in other for other in other_sets):
+                        conflicts.add(fp)
+    finally:
+        for seen in label_sets:
+            seen.close()
+
+    if len(conflicts) > 0:
+        print("\t" + str(len(conflicts)) + " samples are both Positive and Negative; see " + CONFLICTS_FILE)
+        with open(os.path.join(path, CONFLICTS_FILE), "w") as conflicts_writer:
+            for fp in sorted(conflicts):
+                conflicts_writer.write(fp.hex() + "\n")
+    return len(conflicts)
+
+
+# Deduplicates every label folder of path (Positive and Negative, or path itself) across all its shards
+# and reports the samples found in both (see dedupe_folder and find_conflicts)
+def dedupe_corpus(path, dimension=1, digest_size=DIGEST_SIZE, max_memory_fingerprints=MAX_MEMORY_FINGERPRINTS):
+    folders = manifest.label_folders(path)
+    stats = {}
+    for folder in folders:
+        stats[os.path.basename(folder)] = dedupe_folder(folder, dimension, digest_size, max_memory_fingerprints)
+    stats["conflicts"] = find_conflicts(path, folders, dimension, digest_size, max_memory_fingerprints)
+    return stats
@@ -0,0 +1,99 @@
+import os
+import numpy as np
+import dedupe
+import manifest
+import token_store
+
+# Preprocessing of a 1d label folder in a single read of every new shard. While a shard is read, its
+# samples are deduplicated against the folder (see dedupe.py), the kept ones are parsed into the token
+# store (see token_store.py), and a shard left with no content is dropped like delete_empty_files did.
+# The length histograms are then computed from the store offsets without reading the shards again
+# (see length_histogram.py). Shards processed in an earlier run are not read at all: their fingerprints
+# come from their sidecars and their tokens from the previous token store while it still matches them.
+
+
+# Parsed like the lines of the shard would be by token_store.parse_shard
+def _parse_samples(samples, is_c2v):
+    arrays = [token_store.parse_line(sample + "\n", is_c2v) for sample in samples]
+    lengths = np.array([len(arr) for arr in arrays], dtype=np.int64)
+    if len(arrays) == 0:
+        return np.empty(0, dtype=np.int32), lengths
+    return np.concatenate(arrays), lengths
+
+
+# Deduplicates one unprocessed shard into shard + PROCESSED_SUFFIX. Returns the parsed kept samples, or
+# None when nothing (or a single byte) is left of it, and the number of duplicates removed.
+def _process_shard(folder, shard, seen, digest_size, is_c2v):
+    filepath = os.path.join(folder, shard)
+    outfilepath = os.path.join(folder, dedupe.TEMP_FILE)
+    kept = []
+    samples = []
+    duplicates = 0
+    with open(outfilepath, "w") as filewriter:
+        for sample in dedupe.samples_1d(filepath):
+            fp = dedupe.fingerprint(sample, digest_size)
+            if not seen.add(fp):
+                duplicates += 1
+                continue
+            kept.append(fp)
+            samples.append(sample)
+            filewriter.write(sample + "\n")
+    if os.path.getsize(outfilepath) <= 1:
+        print("\tdeleting " + filepath)
+        os.remove(outfilepath)
+        os.remove(filepath)
+        return None, duplicates
+    # The source is removed only once its output is in place
+    dedupe._write_sidecar(dedupe._sidecar(folder, shard + dedupe.PROCESSED_SUFFIX, digest_size), kept)
+    os.replace(outfilepath, filepath + dedupe.PROCESSED_SUFFIX)
+    os.remove(filepath)
+    return _parse_samples(samples, is_c2v), duplicates
+
+
+def preprocess_folder(folder, is_c2v=False, digest_size=dedupe.DIGEST_SIZE,
+                      max_memory_fingerprints=dedupe.MAX_MEMORY_FINGERPRINTS):
+    shards = manifest.shard_files(folder)
+    pending = [f for f in shards if not f.endswith(dedupe.PROCESSED_SUFFIX)]
+    processed = []
+    for shard in [f for f in shards if f.endswith(dedupe.PROCESSED_SUFFIX)]:
+        if shard[:-len(dedupe.PROCESSED_SUFFIX)] in pending:
+            continue  # left by an interrupted run; it is redone
+        if os.path.getsize(os.path.join(folder, shard)) <= 1:
+            print("\tdeleting " + os.path.join(folder, shard))
+            os.remove(os.path.join(folder, shard))
+            continue
+        processed.append(shard)
+
+    seen = dedupe.FingerprintSet(os.path.join(folder, ".dedupe.sqlite"), max_memory_fingerprints)
+    duplicates = 0
+    try:
+        # All the processed samples are known before the first new shard is deduplicated
+        for shard in processed:
+            for fp in dedupe._processed_fingerprints(folder, shard, 1, digest_size):
+                seen.add(fp)
+
+        previous = token_store.stored_shards(folder, is_c2v)
+        writer = token_store.StoreWriter(folder, is_c2v)
+        # The store follows the sorted names of the shards as they are after this pass
+        sources = {shard + dedupe.PROCESSED_SUFFIX: shard for shard in pending}
+        for name in sorted(processed + list(sources)):
+            if name in sources:
+                parsed, shard_duplicates = _process_shard(folder, sources[name], seen, digest_size, is_c2v)
+                duplicates += shard_duplicates
+                if parsed is not None:
+                    writer.add_shard(*parsed)
+                continue
+            stat = os.stat(os.path.join(folder, name))
+            if name in previous and previous[name][0] == (stat.st_size, stat.st_mtime_ns):
+                writer.add_shard(previous[name][1], previous[name][2])
+            else:
+                writer.add_shard(*token_store.parse_shard(os.path.join(folder, name), is_c2v))
+        # The previous store is memory mapped; it has to be released before its files are replaced
+        previous = None
+        writer.close(token_store.folder_signature(folder))
+        unique = len(seen)
+    finally:
+        seen.close()
+    dedupe._remove_orphan_sidecars(folder)
+    print("\t" + folder + ": " + str(unique) + " unique samples, " + str(duplicates) + " duplicates removed")
+    return unique, duplicates
@@ -1,10 +1,12 @@
 class Input_data:
-    def __init__(self, train_data, train_labels, eval_data, eval_labels, max_input_length):
+    def __init__(self, train_data, train_labels, eval_data, eval_labels, max_input_length, max_features=None):
         self.train_data = train_data
         self.train_labels = train_labels
         self.eval_data = eval_data
         self.eval_labels = eval_labels
         self.max_input_length = max_input_length
+        # Largest token id of the corpora (see vocab_stats.py), for the Embedding models
+        self.max_features = max_features
 
 # data class for 2-d data
 class Input_data2:
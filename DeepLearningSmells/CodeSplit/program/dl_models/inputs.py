@@ -1,34 +1,32 @@
 import os
 import numpy as np
 import gc
+from concurrent.futures import ProcessPoolExecutor
 from os import listdir
 from os.path import isfile, join
 from sklearn.model_selection import train_test_split
-from sklearn.utils import shuffle
-
+import token_store
+import length_histogram
+import dedupe
+import fused_preprocess
+import near_duplicates
+import manifest
+import shard_writer
+import vocab_stats
+import corpus_stats
+
+# Seed of the permutations used to split and shuffle the samples; it makes the datasets reproducible across runs
+RANDOM_SEED = 42
+# Number of label folders preprocess_all works on at the same time
+PREPROCESS_WORKERS = os.cpu_count() or 1
 
 # from imblearn.under_sampling import RandomUnderSampler
 
 
-# It is useful for embedding layer: right now we dont have it.
+# It is useful for embedding layer: the largest token id of the samples of folder (or of its Positive and
+# Negative folders). Negative ids are counted in the vocabulary statistics instead of deleting their files.
 def find_max_individual_token(folder):
-    max_value = 0
-    for root, dirs, files in os.walk(folder):
-        for file in files:
-            if file.startswith("."):
-                continue
-            filepath = os.path.join(root, file)
-            input_str = open(filepath, 'r', errors='ignore').read()
-            input_str = input_str.replace("\\t", " ")
-            np_arr = np.fromstring(input_str, dtype=np.int32, sep=" ")
-            for item in np_arr:
-                if item > max_value:
-                    max_value = item
-                if item < 0:
-                    if (os.path.exists(filepath)):
-                        os.remove(filepath)
-                    # print("negative value found in " + file)
-    return max_value
+    return vocab_stats.corpus_vocab(folder)["max_id"]
 
 
 # It assumes that we are going to give input in 2d format. So, it computes sizes in 2 dimensions
@@ -39,18 +37,11 @@ def find_max_individual_token(folder):
 #     max_width, max_height = find_input_size(params.NEGATIVE_CASES, max_width, max_height)
 #     return max_width, max_height
 
+# The widths (characters of a line) and heights (lines of a file) come from the shard statistics (see corpus_stats.py)
 def find_input_size(folder, max_width, max_height):
     for root, dirs, files in os.walk(folder):
-        for file in files:
-            cur_height = 0
-            with open(os.path.join(root, file), encoding="utf8") as fp:
-                for line in fp:
-                    cur_height += 1
-                    cur_width = len(line)
-                    if cur_height > max_height:
-                        max_height = cur_height
-                    if cur_width > max_width:
-                        max_width = cur_width
+        max_width = max(max_width, corpus_stats.maximum(root, "max_line_chars"))
+        max_height = max(max_height, corpus_stats.maximum(root, "lines"))
     return max_width, max_height
 
 
@@ -63,17 +54,10 @@ def find_input_size_1d(folder, max_width):
     return max_width
 
 
+# The number of tokens of the largest file
 def find_tokenized_input_size_1d(folder, max_width):
     for root, dirs, files in os.walk(folder):
-        for file in files:
-            if file.startswith("."):
-                continue
-            input_str = open(os.path.join(root, file), 'r', errors='ignore').read()
-            input_str = input_str.replace("\\t", " ")
-            np_arr = np.fromstring(input_str, dtype=np.int32, sep=" ")
-            cur_width = len(np_arr)
-            if cur_width > max_width:
-                max_width = cur_width
+        max_width = max(max_width, corpus_stats.maximum(root, "tokens"))
     return max_width
 
 
@@ -100,21 +84,14 @@ def item_line_count(path):
         return 0
 
 
+# Every 2d sample ends with an empty line
 def get_total_cases_2d(folder_path):
-    count = 0
-    for file in os.listdir(folder_path):
-        filepath = os.path.join(folder_path, file)
-        if os.path.isfile(filepath):
-            with open(filepath, "r", errors='ignore') as f:
-                for line in f:
-                    if len(line) < 2:
-                        count += 1
-    return count
+    return corpus_stats.total(folder_path, "empty_lines")
 
 
 # I assume there will be no empty lines
 def get_total_cases(folder_path):
-    return sum(map(lambda item: item_line_count(join(folder_path, item)), listdir(folder_path)))
+    return corpus_stats.total(folder_path, "binary_lines")
     # return len([name for name in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, name))])
     # count =0
     # for file in os.listdir(folder_path):
@@ -123,14 +100,14 @@ def get_total_cases(folder_path):
     # return count
 
 
-def get_data_balanced(data_path, train_validate_ratio=0.7, max_training_samples=5000, is_final=False):
-    max_input_length = get_outlier_threshold(data_path, z=1)
+def get_data_balanced(data_path, train_validate_ratio=0.7, max_training_samples=5000, is_final=False,
+                      seed=RANDOM_SEED):
+    rng = np.random.RandomState(seed)
+    pos_samples, neg_samples, max_input_length = _load_cases(data_path, z=1)
 
     # Positive cases
-    folder_path = os.path.join(data_path, "Positive")
-    pos_data_arr = _retrieve_data(folder_path, max_input_length)
-    shuffle(pos_data_arr)
-    total_positive_cases = len(pos_data_arr)
+    pos_indices = rng.permutation(_select_samples(pos_samples, max_input_length))
+    total_positive_cases = len(pos_indices)
 
     total_training_positive_cases = int(train_validate_ratio * total_positive_cases)
     total_eval_positive_cases = int(total_positive_cases - total_training_positive_cases)
@@ -138,10 +115,8 @@ def get_data_balanced(data_path, train_validate_ratio=0.7, max_training_samples=
         total_training_positive_cases = max_training_samples
 
     # Negative cases
-    folder_path = os.path.join(data_path, "Negative")
-    neg_data_arr = _retrieve_data(folder_path, max_input_length)
-    shuffle(neg_data_arr)
-    total_negative_cases = len(neg_data_arr)
+    neg_indices = rng.permutation(_select_samples(neg_samples, max_input_length))
+    total_negative_cases = len(neg_indices)
 
     total_training_negative_cases = int(train_validate_ratio * total_negative_cases)
     total_eval_negative_cases = int(total_negative_cases - total_training_negative_cases)
@@ -152,55 +127,53 @@ def get_data_balanced(data_path, train_validate_ratio=0.7, max_training_samples=
     #     total_eval_positive_cases = int(total_eval_positive_cases / 2)
     #     total_eval_negative_cases = int(total_eval_negative_cases / 2)
 
-    training_data = []
-    training_data.extend(pos_data_arr[0:total_training_positive_cases])
-    training_data.extend(neg_data_arr[0:total_training_negative_cases])
-    training_data_arr = np.array(training_data, dtype=np.float32)
-
-    training_labels = np.empty(shape=[len(training_data_arr)], dtype=np.float32)
-    training_labels[0:total_training_positive_cases] = 1.0
-    training_labels[total_training_positive_cases:len(training_data_arr)] = 0.0
+    training_data, training_labels = _assemble(
+        [(pos_samples, pos_indices[0:total_training_positive_cases], 1.0),
+         (neg_samples, neg_indices[0:total_training_negative_cases], 0.0)], max_input_length, rng)
 
     # random_under_sampler = RandomUnderSampler(random_state=42)
     # training_data_arr_resampled, training_labels_arr_resampled = random_under_sampler.fit_resample(training_data_arr,
     #                                                                                                training_labels)
 
-    eval_data = []
-    eval_data.extend(pos_data_arr[len(pos_data_arr) - total_eval_positive_cases:])
-    eval_data.extend(neg_data_arr[len(neg_data_arr) - total_eval_negative_cases:])
-    eval_data_arr = np.array(eval_data, dtype=np.float32)
+    eval_data, eval_labels = _assemble(
+        [(pos_samples, pos_indices[total_positive_cases - total_eval_positive_cases:], 1.0),
+         (neg_samples, neg_indices[total_negative_cases - total_eval_negative_cases:], 0.0)], max_input_length, rng)
 
-    eval_labels = np.empty(shape=[len(eval_data_arr)], dtype=np.float32)
-    eval_labels[0:total_eval_positive_cases] = 1.0
-    eval_labels[total_eval_positive_cases:] = 0.0
-
-    training_data = training_data_arr.reshape((len(training_labels), max_input_length, 1))
-    eval_data = eval_data_arr.reshape((len(eval_labels), max_input_length, 1))
-    training_data, training_labels = shuffle(training_data, training_labels)
-    eval_data, eval_labels = shuffle(eval_data, eval_labels)
+    training_data = training_data.reshape((len(training_labels), max_input_length, 1))
+    eval_data = eval_data.reshape((len(eval_labels), max_input_length, 1))
 
     return training_data, training_labels, eval_data, eval_labels, max_input_length
 
 
-def get_data_autoencoder(data_path, train_validate_ratio=0.7, max_training_samples=5000, max_eval_samples=150000):
+def get_data_autoencoder(data_path, train_validate_ratio=0.7, max_training_samples=5000, max_eval_samples=150000,
+                         seed=RANDOM_SEED):
     gc.collect()
-    max_input_length = get_outlier_threshold(data_path, z=1)
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_length = \
+        _split_data_autoencoder(data_path, train_validate_ratio, max_training_samples, max_eval_samples, rng)
+
+    # The autoencoder is trained on negative samples only and does not need the labels
+    training_data, _ = _assemble(training_sources, max_input_length, rng)
+    eval_data, eval_labels = _assemble(eval_sources, max_input_length, rng)
+
+    return training_data, eval_data, eval_labels, max_input_length
+
+
+# Seeded split of the sample indices for get_data_autoencoder; it returns the training and evaluation
+# sources for _assemble (or data_sequence.SampleSequence) and the outlier threshold
+def _split_data_autoencoder(data_path, train_validate_ratio, max_training_samples, max_eval_samples, rng):
+    pos_samples, neg_samples, max_input_length = _load_cases(data_path, z=1)
 
-    all_inputs = []
     # Positive cases
-    folder_path = os.path.join(data_path, "Positive")
-    pos_data_arr = _retrieve_data(folder_path, max_input_length)
-    shuffle(pos_data_arr)
-    total_positive_cases = len(pos_data_arr)
+    pos_indices = rng.permutation(_select_samples(pos_samples, max_input_length))
+    total_positive_cases = len(pos_indices)
 
     # total_training_positive_cases = int(train_validate_ratio * total_positive_cases)
     total_eval_positive_cases = total_positive_cases
 
     # Negative cases
-    folder_path = os.path.join(data_path, "Negative")
-    neg_data_arr = _retrieve_data(folder_path, max_input_length)
-    shuffle(neg_data_arr)
-    total_negative_cases = len(neg_data_arr)
+    neg_indices = rng.permutation(_select_samples(neg_samples, max_input_length))
+    total_negative_cases = len(neg_indices)
 
     total_training_negative_cases = int(train_validate_ratio * total_negative_cases)
     total_eval_negative_cases = int(total_negative_cases - total_training_negative_cases)
@@ -208,14 +181,7 @@ def get_data_autoencoder(data_path, train_validate_ratio=0.7, max_training_sampl
     # We balance training samples and apply max threshold for training sample count
     total_training_negative_cases = min(max_training_samples, total_training_negative_cases)
 
-    training_data = []
-    # training_data.extend(pos_data_arr[0:total_training_positive_cases])
-    training_data.extend(neg_data_arr[0:total_training_negative_cases])
-    training_data_arr = np.array(training_data, dtype=np.float32)
-
-    # training_labels = np.empty(shape=[len(training_data_arr)], dtype=np.float32)
-    # training_labels[0:total_training_positive_cases] = 1.0
-    # training_labels[total_training_positive_cases:len(training_data_arr)] = 0.0
+    training_sources = [(neg_samples, neg_indices[0:total_training_negative_cases], 0.0)]
 
     # we need to remove extraneous samples from evaluation to keep the compuation in reasonable bounds
     if total_eval_negative_cases > max_eval_samples:
@@ -223,45 +189,48 @@ def get_data_autoencoder(data_path, train_validate_ratio=0.7, max_training_sampl
         total_eval_positive_cases = int(total_eval_positive_cases - total_eval_positive_cases * removed_sample_percent)
         total_eval_negative_cases = max_eval_samples
 
-    eval_data = []
-    eval_data.extend(pos_data_arr[len(pos_data_arr) - total_eval_positive_cases:])
-    eval_data.extend(neg_data_arr[len(neg_data_arr) - total_eval_negative_cases:])
-    eval_data_arr = np.array(eval_data, dtype=np.float32)
-
-    eval_labels = np.empty(shape=[len(eval_data_arr)], dtype=np.float32)
-    eval_labels[0:total_eval_positive_cases] = 1.0
-    eval_labels[total_eval_positive_cases:] = 0.0
+    eval_sources = [(pos_samples, pos_indices[total_positive_cases - total_eval_positive_cases:], 1.0),
+                    (neg_samples, neg_indices[total_negative_cases - total_eval_negative_cases:], 0.0)]
 
-    # train_data, eval_data, train_labels, eval_labels = train_test_split(np_arr_all, labels, train_size=train_validate_ratio)
-    # training_data = training_data_arr.reshape((len(training_data_arr), max_input_length, 1))
-    training_data = training_data_arr.reshape((len(training_data_arr), max_input_length))
-    # eval_data = eval_data_arr.reshape((len(eval_labels), max_input_length, 1))
-    eval_data = eval_data_arr.reshape((len(eval_labels), max_input_length))
-    training_data = shuffle(training_data)
-    eval_data, eval_labels = shuffle(eval_data, eval_labels)
+    return training_sources, eval_sources, max_input_length
 
-    return training_data, eval_data, eval_labels, max_input_length
 
-def get_data(data_path, train_validate_ratio=0.7, max_training_samples=5000, max_eval_samples=150000, is_c2v=False):
+# token_ids keeps the samples as integer token ids (for Embedding layers) in the smallest dtype that fits
+# the vocabulary instead of float32; it is ignored for Code2Vec vectors
+def get_data(data_path, train_validate_ratio=0.7, max_training_samples=5000, max_eval_samples=150000, is_c2v=False,
+             seed=RANDOM_SEED, token_ids=False, vocab_size=None):
     gc.collect()
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_length = \
+        _split_data(data_path, train_validate_ratio, max_training_samples, max_eval_samples, is_c2v, rng)
+
+    dtype, table = data_encoding(data_path, training_sources + eval_sources, token_ids and not is_c2v, vocab_size,
+                                 manifest.label_folders(data_path))
+    training_data, training_labels = _assemble(training_sources, max_input_length, rng, dtype, table)
+    eval_data, eval_labels = _assemble(eval_sources, max_input_length, rng, dtype, table)
+
+    # reshape returns views of the assembled buffers; no copy of the data is made
+    training_data = training_data.reshape((len(training_labels), max_input_length, 1))
+    eval_data = eval_data.reshape((len(eval_labels), max_input_length, 1))
+
+    return training_data, training_labels, eval_data, eval_labels, max_input_length
+
 
-    max_input_length = get_outlier_threshold(data_path, z=1, is_c2v=is_c2v)
+# Seeded split of the sample indices for get_data; it returns the training and evaluation
+# sources for _assemble (or data_sequence.SampleSequence) and the outlier threshold
+def _split_data(data_path, train_validate_ratio, max_training_samples, max_eval_samples, is_c2v, rng):
+    pos_samples, neg_samples, max_input_length = _load_cases(data_path, z=1, is_c2v=is_c2v)
 
-    all_inputs = []
     # Positive cases
-    folder_path = os.path.join(data_path, "Positive")
-    pos_data_arr = _retrieve_data(folder_path, max_input_length, is_c2v)
-    shuffle(pos_data_arr)
-    total_positive_cases = len(pos_data_arr)
+    pos_indices = rng.permutation(_select_samples(pos_samples, max_input_length))
+    total_positive_cases = len(pos_indices)
 
     total_training_positive_cases = int(train_validate_ratio * total_positive_cases)
     total_eval_positive_cases = int(total_positive_cases - total_training_positive_cases)
 
     # Negative cases
-    folder_path = os.path.join(data_path, "Negative")
-    neg_data_arr = _retrieve_data(folder_path, max_input_length, is_c2v)
-    shuffle(neg_data_arr)
-    total_negative_cases = len(neg_data_arr)
+    neg_indices = rng.permutation(_select_samples(neg_samples, max_input_length))
+    total_negative_cases = len(neg_indices)
 
     total_training_negative_cases = int(train_validate_ratio * total_negative_cases)
     total_eval_negative_cases = int(total_negative_cases - total_training_negative_cases)
@@ -271,14 +240,8 @@ def get_data(data_path, train_validate_ratio=0.7, max_training_samples=5000, max
                                                                         min(total_training_positive_cases,
                                                                             total_training_negative_cases))
 
-    training_data = []
-    training_data.extend(pos_data_arr[0:total_training_positive_cases])
-    training_data.extend(neg_data_arr[0:total_training_negative_cases])
-    training_data_arr = np.array(training_data, dtype=np.float32)
-
-    training_labels = np.empty(shape=[len(training_data_arr)], dtype=np.float32)
-    training_labels[0:total_training_positive_cases] = 1.0
-    training_labels[total_training_positive_cases:len(training_data_arr)] = 0.0
+    training_sources = [(pos_samples, pos_indices[0:total_training_positive_cases], 1.0),
+                        (neg_samples, neg_indices[0:total_training_negative_cases], 0.0)]
 
     # just for experiments
     # total_eval_negative_cases = min(len(neg_data_arr) - total_eval_negative_cases, total_eval_positive_cases * 2)
@@ -289,72 +252,61 @@ def get_data(data_path, train_validate_ratio=0.7, max_training_samples=5000, max
         total_eval_positive_cases = int(total_eval_positive_cases - total_eval_positive_cases * removed_sample_percent)
         total_eval_negative_cases = max_eval_samples
 
-    eval_data = []
-    eval_data.extend(pos_data_arr[len(pos_data_arr) - total_eval_positive_cases:])
-    eval_data.extend(neg_data_arr[len(neg_data_arr) - total_eval_negative_cases:])
-    eval_data_arr = np.array(eval_data, dtype=np.float32)
-
-    eval_labels = np.empty(shape=[len(eval_data_arr)], dtype=np.float32)
-    eval_labels[0:total_eval_positive_cases] = 1.0
-    eval_labels[total_eval_positive_cases:] = 0.0
-
-    # total_positive_cases = total_training_positive_cases + total_eval_positive_cases
-    # total_negative_cases = total_training_negative_cases + total_eval_negative_cases
-    #
-    # # all_inputs.extend(pos_data_arr[0:total_positive_cases])
-    # # all_inputs.extend(neg_data_arr[0:total_negative_cases])
-    # all_inputs.extend(pos_data_arr)
-    # all_inputs.extend(neg_data_arr)
-    #
-    # labels = np.empty(shape=[len(all_inputs)], dtype=np.float32)
-    # labels[0:len(pos_data_arr)] = 1.0
-    # labels[len(pos_data_arr):len(all_inputs)] = 0.0
-    #
-    # np_arr_all = np.array(all_inputs, dtype=np.float32)
-    # # all_data = np_arr_all.reshape((len(labels), max_input_length, 1))
-    #
-    # write_input_data_summary(out_folder, case_string,
-    #                          total_training_positive_cases, total_training_negative_cases,
-    #                          total_eval_positive_cases, total_eval_negative_cases)
-    #
-    # train_data, eval_data, train_labels, eval_labels = train_test_split(np_arr_all, labels, train_size=train_validate_ratio)
-    training_data = training_data_arr.reshape((len(training_labels), max_input_length, 1))
-    eval_data = eval_data_arr.reshape((len(eval_labels), max_input_length, 1))
-    training_data, training_labels = shuffle(training_data, training_labels)
-    eval_data, eval_labels = shuffle(eval_data, eval_labels)
+    eval_sources = [(pos_samples, pos_indices[total_positive_cases - total_eval_positive_cases:], 1.0),
+                    (neg_samples, neg_indices[total_negative_cases - total_eval_negative_cases:], 0.0)]
 
-    return training_data, training_labels, eval_data, eval_labels, max_input_length
+    return training_sources, eval_sources, max_input_length
 
 
 def get_data_rq2(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio=0.7,
-                 max_training_samples=5000, max_eval_samples=150000):
+                 max_training_samples=5000, max_eval_samples=150000, seed=RANDOM_SEED, token_ids=False,
+                 vocab_size=None):
     gc.collect()
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_length = \
+        _split_data_rq2(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio,
+                        max_training_samples, max_eval_samples, rng)
+
+    dtype, table = data_encoding(training_data_path, training_sources + eval_sources, token_ids, vocab_size,
+                                 manifest.label_folders(training_data_path) + manifest.label_folders(eval_data_path))
+    training_data_arr, training_labels = _assemble(training_sources, max_input_length, rng, dtype, table)
+    eval_data_arr, eval_labels = _assemble(eval_sources, max_input_length, rng, dtype, table)
+
+    training_data_arr = training_data_arr.reshape((len(training_labels), max_input_length, 1))
+    eval_data_arr = eval_data_arr.reshape((len(eval_labels), max_input_length, 1))
+
+    return training_data_arr, training_labels, eval_data_arr, eval_labels, max_input_length
 
-    max_input_length = get_outlier_threshold(training_data_path, z=1)
 
-    tr_pos_data_arr = _retrieve_data(os.path.join(training_data_path, "Positive"), max_input_length)
-    total_tr_positive_cases = len(tr_pos_data_arr)
+# Seeded split of the sample indices for get_data_rq2; it returns the training and evaluation
+# sources for _assemble (or data_sequence.SampleSequence) and the outlier threshold
+def _split_data_rq2(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio,
+                    max_training_samples, max_eval_samples, rng):
+    tr_pos_samples, tr_neg_samples, max_input_length = _load_cases(training_data_path, z=1)
+
+    tr_pos_indices = rng.permutation(_select_samples(tr_pos_samples, max_input_length))
+    total_tr_positive_cases = len(tr_pos_indices)
     total_training_positive_cases = int(train_validate_ratio * total_tr_positive_cases)
 
-    ev_pos_data_arr = _retrieve_data(os.path.join(eval_data_path, "Positive"), max_input_length)
-    total_eval_positive_cases = len(ev_pos_data_arr)
+    ev_pos_samples = _load_samples(os.path.join(eval_data_path, "Positive"))
+    ev_pos_indices = rng.permutation(_select_samples(ev_pos_samples, max_input_length))
+    total_eval_positive_cases = len(ev_pos_indices)
 
-    tr_neg_data_arr = _retrieve_data(os.path.join(training_data_path, "Negative"), max_input_length)
-    total_tr_negative_cases = len(tr_neg_data_arr)
+    tr_neg_indices = rng.permutation(_select_samples(tr_neg_samples, max_input_length))
+    total_tr_negative_cases = len(tr_neg_indices)
     total_training_negative_cases = int(train_validate_ratio * total_tr_negative_cases)
 
-    ev_neg_data_arr = _retrieve_data(os.path.join(eval_data_path, "Negative"), max_input_length)
-    total_eval_negative_cases = len(ev_neg_data_arr)
+    ev_neg_samples = _load_samples(os.path.join(eval_data_path, "Negative"))
+    ev_neg_indices = rng.permutation(_select_samples(ev_neg_samples, max_input_length))
+    total_eval_negative_cases = len(ev_neg_indices)
 
     # We balance training samples and apply max threshold for training sample count
     total_training_positive_cases = total_training_negative_cases = min(max_training_samples,
                                                                         min(total_training_positive_cases,
                                                                             total_training_negative_cases))
 
-    training_data = []
-    training_data.extend(tr_pos_data_arr[0:total_training_positive_cases])
-    training_data.extend(tr_neg_data_arr[0:total_training_negative_cases])
-    training_data_arr = np.array(training_data, dtype=np.float32)
+    training_sources = [(tr_pos_samples, tr_pos_indices[0:total_training_positive_cases], 1.0),
+                        (tr_neg_samples, tr_neg_indices[0:total_training_negative_cases], 0.0)]
 
     # we need to remove extraneous samples from evaluation to keep the compuation in reasonable bounds
     if total_eval_negative_cases > max_eval_samples:
@@ -362,125 +314,212 @@ def get_data_rq2(training_data_path, eval_data_path, out_folder, case_string, tr
         total_eval_positive_cases = int(total_eval_positive_cases - total_eval_positive_cases * removed_sample_percent)
         total_eval_negative_cases = max_eval_samples
 
-    eval_data = []
-    eval_data.extend(ev_pos_data_arr[0:total_eval_positive_cases])
-    eval_data.extend(ev_neg_data_arr[0:total_eval_negative_cases])
-    eval_data_arr = np.array(eval_data, dtype=np.float32)
-
-    training_labels = np.empty(shape=[len(training_data_arr)], dtype=np.float32)
-    training_labels[0:total_training_positive_cases] = 1.0
-    training_labels[total_training_positive_cases:len(training_data_arr)] = 0.0
-
-    eval_labels = np.empty(shape=[len(eval_data_arr)], dtype=np.float32)
-    eval_labels[0:total_eval_positive_cases] = 1.0
-    eval_labels[total_eval_positive_cases:len(eval_data_arr)] = 0.0
-
-    training_data_arr = training_data_arr.reshape((len(training_labels), max_input_length, 1))
-    eval_data_arr = eval_data_arr.reshape((len(eval_labels), max_input_length, 1))
-    training_data_arr, training_labels = shuffle(training_data_arr, training_labels)
-    eval_data_arr, eval_labels = shuffle(eval_data_arr, eval_labels)
+    eval_sources = [(ev_pos_samples, ev_pos_indices[0:total_eval_positive_cases], 1.0),
+                    (ev_neg_samples, ev_neg_indices[0:total_eval_negative_cases], 0.0)]
 
     write_input_data_summary(out_folder, case_string,
                              total_training_positive_cases, total_training_negative_cases,
                              total_eval_positive_cases, total_eval_negative_cases)
 
-    return training_data_arr, training_labels, eval_data_arr, eval_labels, max_input_length
+    return training_sources, eval_sources, max_input_length
 
 
 def get_data_2d_rq2(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio=0.7,
-                    max_training_samples=5000):
+                    max_training_samples=5000, seed=RANDOM_SEED):
     gc.collect()
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_height, max_input_width = \
+        _split_data_2d_rq2(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio,
+                           max_training_samples, rng)
+
+    training_data_arr, training_labels = _assemble_2d(training_sources, max_input_height, max_input_width, rng)
+    eval_data_arr, eval_labels = _assemble_2d(eval_sources, max_input_height, max_input_width, rng)
 
+    training_data_arr = training_data_arr.reshape((len(training_labels), max_input_height, max_input_width, 1))
+    eval_data_arr = eval_data_arr.reshape((len(eval_labels), max_input_height, max_input_width, 1))
+
+    return training_data_arr, training_labels, eval_data_arr, eval_labels, max_input_height, max_input_width
+
+
+# Seeded split of the sample indices for get_data_2d_rq2; it returns the training and evaluation sources
+# for _assemble_2d (or data_sequence.Sample2dSequence) and the outlier thresholds
+def _split_data_2d_rq2(training_data_path, eval_data_path, out_folder, case_string, train_validate_ratio,
+                       max_training_samples, rng):
     max_input_width, max_input_height = get_outlier_threshold_2d(training_data_path, z=1)
 
-    tr_pos_data_arr = _retrieve_data_2d(os.path.join(training_data_path, "Positive"), max_input_width, max_input_height)
-    total_tr_positive_cases = len(tr_pos_data_arr)
+    tr_pos_samples = _load_samples_2d(os.path.join(training_data_path, "Positive"))
+    tr_pos_selected = _select_samples_2d(tr_pos_samples, max_input_height)
+    total_tr_positive_cases = len(tr_pos_selected)
     total_training_positive_cases = int(train_validate_ratio * total_tr_positive_cases)
 
-    ev_pos_data_arr = _retrieve_data_2d(os.path.join(eval_data_path, "Positive"), max_input_width, max_input_height)
-    total_eval_positive_cases = len(ev_pos_data_arr)
+    ev_pos_samples = _load_samples_2d(os.path.join(eval_data_path, "Positive"))
+    ev_pos_selected = _select_samples_2d(ev_pos_samples, max_input_height)
+    total_eval_positive_cases = len(ev_pos_selected)
 
-    tr_neg_data_arr = _retrieve_data_2d(os.path.join(training_data_path, "Negative"), max_input_width, max_input_height)
-    total_tr_negative_cases = len(tr_neg_data_arr)
+    tr_neg_samples = _load_samples_2d(os.path.join(training_data_path, "Negative"))
+    tr_neg_selected = _select_samples_2d(tr_neg_samples, max_input_height)
+    total_tr_negative_cases = len(tr_neg_selected)
     total_training_negative_cases = int(train_validate_ratio * total_tr_negative_cases)
 
-    ev_neg_data_arr = _retrieve_data_2d(os.path.join(eval_data_path, "Negative"), max_input_width, max_input_height)
-    total_eval_negative_cases = len(ev_neg_data_arr)
+    ev_neg_samples = _load_samples_2d(os.path.join(eval_data_path, "Negative"))
+    ev_neg_selected = _select_samples_2d(ev_neg_samples, max_input_height)
+    total_eval_negative_cases = len(ev_neg_selected)
 
     # We balance training samples and apply max threshold for training sample count
     total_training_positive_cases = total_training_negative_cases = min(max_training_samples,
                                                                         min(total_training_positive_cases,
                                                                             total_training_negative_cases))
 
-    training_data = []
-    training_data.extend(tr_pos_data_arr[0:total_training_positive_cases])
-    training_data.extend(tr_neg_data_arr[0:total_training_negative_cases])
-    training_data_arr = np.array(training_data, dtype=np.float32)
-
-    eval_data = []
-    eval_data.extend(ev_pos_data_arr[0:total_eval_positive_cases])
-    eval_data.extend(ev_neg_data_arr[0:total_eval_negative_cases])
-    eval_data_arr = np.array(eval_data, dtype=np.float32)
-
-    training_labels = np.empty(shape=[len(training_data_arr)], dtype=np.float32)
-    training_labels[0:total_training_positive_cases] = 1.0
-    training_labels[total_training_positive_cases:len(training_data_arr)] = 0.0
+    tr_pos_indices = rng.permutation(tr_pos_selected)
+    tr_neg_indices = rng.permutation(tr_neg_selected)
+    training_sources = [(tr_pos_samples, tr_pos_indices[0:total_training_positive_cases], 1.0),
+                        (tr_neg_samples, tr_neg_indices[0:total_training_negative_cases], 0.0)]
 
-    eval_labels = np.empty(shape=[len(eval_data_arr)], dtype=np.float32)
-    eval_labels[0:total_eval_positive_cases] = 1.0
-    eval_labels[total_eval_positive_cases:len(eval_data_arr)] = 0.0
-
-    training_data_arr = training_data_arr.reshape((len(training_labels), max_input_height, max_input_width, 1))
-    eval_data_arr = eval_data_arr.reshape((len(eval_labels), max_input_height, max_input_width, 1))
-    training_data_arr, training_labels = shuffle(training_data_arr, training_labels)
-    eval_data_arr, eval_labels = shuffle(eval_data_arr, eval_labels)
+    eval_sources = [(ev_pos_samples, ev_pos_selected, 1.0),
+                    (ev_neg_samples, ev_neg_selected, 0.0)]
 
     write_input_data_summary(out_folder, case_string,
                              total_training_positive_cases, total_training_negative_cases,
                              total_eval_positive_cases, total_eval_negative_cases)
 
-    return training_data_arr, training_labels, eval_data_arr, eval_labels, max_input_height, max_input_width
+    return training_sources, eval_sources, max_input_height, max_input_width
+
+
+# Loads all the samples of a folder in a single pass: from the token store when it is current,
+# otherwise by parsing each line of the text shards once
+def _load_samples(path, is_c2v=False):
+    if token_store.is_store_current(path, is_c2v):
+        return token_store.load_store(path)
+    return token_store.parse_folder(path, is_c2v)
+
+
+# Loads Positive and Negative cases of data_path; the outlier threshold is computed
+# from the sample lengths recorded while loading, so the files are not walked twice.
+def _load_cases(data_path, z=1, is_c2v=False):
+    pos_samples = _load_samples(os.path.join(data_path, "Positive"), is_c2v)
+    neg_samples = _load_samples(os.path.join(data_path, "Negative"), is_c2v)
+    len1 = length_histogram.compute_max(
+        length_histogram.folder_histogram(os.path.join(data_path, "Positive"), is_c2v, pos_samples[1]), z=z)
+    len2 = length_histogram.compute_max(
+        length_histogram.folder_histogram(os.path.join(data_path, "Negative"), is_c2v, neg_samples[1]), z=z)
+    return pos_samples, neg_samples, max(len1, len2)
+
+
+# Indices of the samples that are not longer than the outlier threshold
+def _select_samples(samples, max_len):
+    return np.flatnonzero(token_store.sample_lengths(samples[1]) <= max_len)
+
+
+# The 2d samples in their ragged form (values, line offsets, sample offsets); see token_store.py
+def _load_samples_2d(path):
+    if token_store.is_store_2d_current(path):
+        return token_store.load_store_2d(path)
+    return token_store.parse_folder_2d(path)
+
+
+# Indices of the 2d samples with fewer lines than the outlier threshold; longer lines are truncated
+# to the width threshold when the samples are padded
+def _select_samples_2d(samples, max_input_height):
+    line_counts = token_store.sample_lengths(samples[2])
+    return np.flatnonzero((line_counts > 0) & (line_counts < max_input_height))
+
+
+# dtype of the assembled samples: the CNN and autoencoder models take float32 inputs, whereas token ids
+# for Embedding layers are kept as uint16 (or int32 for vocabularies above 65535 tokens)
+# The token range recorded in the stores of folders (the folders the sources were loaded from) is used
+# when they all have one, instead of scanning the values
+def data_dtype(sources, token_ids=False, folders=None):
+    if not token_ids:
+        return np.dtype(np.float32)
+    if folders is not None:
+        ranges = [token_store.token_range(folder) for folder in folders]
+        if all(token_range is not None for token_range in ranges):
+            return token_store.range_dtype(min(r[0] for r in ranges), max(r[1] for r in ranges))
+    return token_store.compact_dtype([values for (values, _), _, _ in sources])
+
+
+# dtype of the assembled samples and the vocabulary lookup table to apply to them. With token_ids and a
+# vocab_size, the ids are ranked by their frequency in the corpus at data_path and only the vocab_size most
+# frequent ones are kept (see vocab_stats.remap_table).
+def data_encoding(data_path, sources, token_ids=False, vocab_size=None, folders=None):
+    if token_ids and vocab_size is not None:
+        table = vocab_stats.remap_table(vocab_stats.corpus_vocab(data_path), vocab_size)
+        return table.dtype, table
+    return data_dtype(sources, token_ids, folders), None
+
+
+# Writes the selected samples straight into one preallocated (samples, max_len) buffer and a matching
+# label vector. sources is a list of ((values, offsets), sample indices, label) tuples.
+# The samples are written in a (seeded) random row order, which shuffles the data without copying it.
+def _assemble(sources, max_len, rng, dtype=np.float32, table=None):
+    total = sum(len(indices) for _, indices, _ in sources)
+    data = np.zeros((total, max_len), dtype=dtype)
+    labels = np.empty(total, dtype=np.float32)
+    order = rng.permutation(total)
+    start = 0
+    for (values, offsets), indices, label in sources:
+        out_rows = order[start:start + len(indices)]
+        token_store.pad_samples_into(values, offsets, indices, data, out_rows, table)
+        labels[out_rows] = label
+        start += len(indices)
+    return data, labels
+
+
+# The 2d counterpart of _assemble; sources is a list of ((values, line offsets, sample offsets),
+# sample indices, label) tuples. Only the (samples, height, width) buffer is allocated; there is no
+# intermediate zero padded matrix per sample.
+def _assemble_2d(sources, max_input_height, max_input_width, rng):
+    total = sum(len(indices) for _, indices, _ in sources)
+    data = np.zeros((total, max_input_height, max_input_width), dtype=np.float32)
+    labels = np.empty(total, dtype=np.float32)
+    order = rng.permutation(total)
+    start = 0
+    for (values, line_offsets, sample_offsets), indices, label in sources:
+        out_rows = order[start:start + len(indices)]
+        token_store.pad_samples_2d_into(values, line_offsets, sample_offsets, indices, data, out_rows)
+        labels[out_rows] = label
+        start += len(indices)
+    return data, labels
 
 
 def _retrieve_data(path, max_len, is_c2v=False):
-    input = []
-    for file in os.listdir(path):
-        with open(os.path.join(path, file), 'r',
-                  errors='ignore') as file_read:
-            for line in file_read:
-                input_str = line.replace("\t", " ")
-                if is_c2v:
-                    arr = np.fromstring(input_str, dtype=np.float, sep=" ", count=max_len)
-                    arr_size = len(np.fromstring(input_str, dtype=np.float, sep=" "))
-                else:
-                    arr = np.fromstring(input_str, dtype=np.int32, sep=" ", count=max_len)
-                    arr_size = len(np.fromstring(input_str, dtype=np.int32, sep=" "))
-                # We add this file only if the width is less than the outlier threshold
-                if arr_size <= max_len:
-                    arr[arr_size:max_len] = 0
-                    input.append(arr)
-    return input
+    # We add a sample only if the width is less than the outlier threshold
+    values, offsets = _load_samples(path, is_c2v)
+    return token_store.pad_samples(values, offsets, max_len)
 
 
-def get_data_2d(data_path, out_folder, case_string, train_validate_ratio=0.7, max_training_samples=5000):
+def get_data_2d(data_path, out_folder, case_string, train_validate_ratio=0.7, max_training_samples=5000,
+                seed=RANDOM_SEED):
     gc.collect()
+    rng = np.random.RandomState(seed)
+    training_sources, eval_sources, max_input_height, max_input_width = \
+        _split_data_2d(data_path, out_folder, case_string, train_validate_ratio, max_training_samples, rng)
+
+    training_data, training_labels = _assemble_2d(training_sources, max_input_height, max_input_width, rng)
+    eval_data, eval_labels = _assemble_2d(eval_sources, max_input_height, max_input_width, rng)
+
+    training_data = training_data.reshape((len(training_labels), max_input_height, max_input_width, 1))
+    eval_data = eval_data.reshape((len(eval_labels), max_input_height, max_input_width, 1))
+    return training_data, training_labels, eval_data, eval_labels, max_input_height, max_input_width
+
+
+# Seeded split of the sample indices for get_data_2d; it returns the training and evaluation sources
+# for _assemble_2d (or data_sequence.Sample2dSequence) and the outlier thresholds
+def _split_data_2d(data_path, out_folder, case_string, train_validate_ratio, max_training_samples, rng):
     max_input_width, max_input_height = get_outlier_threshold_2d(data_path, z=1)
 
-    all_inputs = []
     # Positive cases
-    folder_path = os.path.join(data_path, "Positive")
-    pos_data_arr = _retrieve_data_2d(folder_path, max_input_width, max_input_height)
-    shuffle(pos_data_arr)
-    total_positive_cases = len(pos_data_arr)
+    pos_samples = _load_samples_2d(os.path.join(data_path, "Positive"))
+    pos_indices = rng.permutation(_select_samples_2d(pos_samples, max_input_height))
+    total_positive_cases = len(pos_indices)
 
     total_training_positive_cases = int(train_validate_ratio * total_positive_cases)
     total_eval_positive_cases = int(total_positive_cases - total_training_positive_cases)
 
     # Negative cases
-    folder_path = os.path.join(data_path, "Negative")
-    neg_data_arr = _retrieve_data_2d(folder_path, max_input_width, max_input_height)
-    shuffle(neg_data_arr)
-    total_negative_cases = len(neg_data_arr)
+    neg_samples = _load_samples_2d(os.path.join(data_path, "Negative"))
+    neg_indices = rng.permutation(_select_samples_2d(neg_samples, max_input_height))
+    total_negative_cases = len(neg_indices)
 
     total_training_negative_cases = int(train_validate_ratio * total_negative_cases)
     total_eval_negative_cases = int(total_negative_cases - total_training_negative_cases)
@@ -490,96 +529,27 @@ def get_data_2d(data_path, out_folder, case_string, train_validate_ratio=0.7, ma
                                                                         min(total_training_positive_cases,
                                                                             total_training_negative_cases))
 
-    training_data = []
-    training_data.extend(pos_data_arr[0:total_training_positive_cases])
-    training_data.extend(neg_data_arr[0:total_training_negative_cases])
-    training_data_arr = np.array(training_data, dtype=np.float32)
-
-    training_labels = np.empty(shape=[len(training_data_arr)], dtype=np.float32)
-    training_labels[0:total_training_positive_cases] = 1.0
-    training_labels[total_training_positive_cases:len(training_data_arr)] = 0.0
+    training_sources = [(pos_samples, pos_indices[0:total_training_positive_cases], 1.0),
+                        (neg_samples, neg_indices[0:total_training_negative_cases], 0.0)]
 
     # just for experiments
     # total_eval_negative_cases = min(len(neg_data_arr) - total_eval_negative_cases, total_eval_positive_cases * 2)
 
-    eval_data = []
-    eval_data.extend(pos_data_arr[len(pos_data_arr) - total_eval_positive_cases:])
-    eval_data.extend(neg_data_arr[len(neg_data_arr) - total_eval_negative_cases:])
-    eval_data_arr = np.array(eval_data, dtype=np.float32)
-
-    eval_labels = np.empty(shape=[len(eval_data_arr)], dtype=np.float32)
-    eval_labels[0:total_eval_positive_cases] = 1.0
-    eval_labels[total_eval_positive_cases:] = 0.0
-
-    # total_positive_cases = total_training_positive_cases + total_eval_positive_cases
-    # total_negative_cases = total_training_negative_cases + total_eval_negative_cases
-    #
-    # all_inputs.extend(pos_data_arr[0:total_positive_cases])
-    # all_inputs.extend(neg_data_arr[0:total_negative_cases])
-    #
-    # labels = np.empty(shape=[len(all_inputs)], dtype=np.float32)
-    # labels[0:total_positive_cases] = 1.0
-    # labels[total_positive_cases:len(all_inputs)] = 0
-    #
-    # input_arr = np.array(all_inputs, dtype=np.float32)
+    eval_sources = [(pos_samples, pos_indices[total_positive_cases - total_eval_positive_cases:], 1.0),
+                    (neg_samples, neg_indices[total_negative_cases - total_eval_negative_cases:], 0.0)]
+
     write_input_data_summary(out_folder, case_string,
                              total_training_positive_cases, total_training_negative_cases,
                              total_eval_positive_cases, total_eval_negative_cases)
 
-    # train_data, eval_data, train_labels, eval_labels = train_test_split(input_arr, labels,
-    #                                                                     train_size=train_validate_ratio)
-    training_data = training_data_arr.reshape((len(training_labels), max_input_height, max_input_width, 1))
-    eval_data = eval_data_arr.reshape((len(eval_labels), max_input_height, max_input_width, 1))
-    training_data, training_labels = shuffle(training_data, training_labels)
-    eval_data, eval_labels = shuffle(eval_data, eval_labels)
-    return training_data, training_labels, eval_data, eval_labels, max_input_height, max_input_width
-
-
-def _retrieve_data_2d(path, max_input_width, max_input_height):
-    input = []
-    cur_index = 1
-    for file in os.listdir(path):
-        if file.startswith("."):
-            continue
-        with open(os.path.join(path, file), 'r', errors='ignore') as f:
-            cur_input = np.zeros((max_input_height, max_input_width), dtype=np.int32)
-            is_valid = True
-            no_of_lines = 0
-            for line in f:
-                input_str = line.strip("\n").replace("\t", " ")
-                if input_str == "\n" or input_str == "":  # end of current sample
-                    # We add only if the heigth is less than the outlier threshold
-                    if is_valid and max_input_height > no_of_lines > 0:
-                        input.append(np.array(cur_input, dtype=np.int32))
-                    no_of_lines = 0
-                    is_valid = True
-                    cur_input = np.zeros((max_input_height, max_input_width), dtype=np.int32)
-                    cur_index += 1
-                    # print('cur_index: ' + str(cur_index))
-                    continue
-
-                if is_valid:
-                    arr = np.fromstring(input_str, dtype=np.int32, sep=" ", count=max_input_width)
-                    arr_size = len(np.fromstring(input_str, dtype=np.int32, sep=" "))
-                    # It was earlier: We add this file only if the width is less than the outlier threshold
-                    # Its new strategy: We add the sample but truncate the lines more than max_input_width
-                    if arr_size > max_input_width:
-                        # is_valid = False
-                        arr_size = max_input_width
-                        arr = arr[:arr_size]
-                    # else:
-                    arr[arr_size:max_input_width] = 0
-                    if no_of_lines < max_input_height:
-                        cur_input[no_of_lines] = arr
-                        no_of_lines += 1
-                    else:
-                        is_valid = False
-    return input
+    return training_sources, eval_sources, max_input_height, max_input_width
 
 
 def delete_empty_files(path):
     for root, dirs, files in os.walk(path):
         for f in files:
+            if f.startswith("."):
+                continue
             fullname = os.path.join(root, f)
             try:
                 if os.path.getsize(fullname) <= 1:
@@ -615,22 +585,7 @@ def handle_overloaded_methods(path):
 
 
 def _get_outlier_threshold(path, z, is_c2v):
-    lengths = []
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            if f.startswith("."):
-                continue
-            filepath = os.path.join(root, f)
-            with open(filepath, "r", errors='ignore') as file:
-                for line in file:
-                    input_str = line.replace("\t", " ")
-                    if is_c2v:
-                        np_arr = np.fromstring(input_str, dtype=np.float, sep=" ")
-                    else:
-                        np_arr = np.fromstring(input_str, dtype=np.int32, sep=" ")
-                    cur_width = len(np_arr)
-                    lengths.append(cur_width)
-    return compute_max(lengths, z=z)
+    return length_histogram.compute_max(length_histogram.folder_histogram(path, is_c2v), z=z)
 
 
 # The second parameter is used to specify the threshold for outlier removal
@@ -656,176 +611,214 @@ def get_outlier_threshold_2d(path, z=1):
 
 
 def _get_outlier_threshold_2d(path, z=2):
-    widths = []
-    heights = []
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            if f.startswith("."):
-                continue
-            filepath = os.path.join(root, f)
-            longest_line_length = 0
-            no_of_lines = 0
-            with open(filepath, "r", errors='ignore') as f:
-                for line in f:
-                    symbol_length = len(line.split('\t'))
-                    if len(line) < 2:  # which means current method ends here
-                        widths.append(longest_line_length)
-                        # in order to keep standard deviation low, removing very high number of lines
-                        if no_of_lines < 2000:
-                            heights.append(no_of_lines)
-                        longest_line_length = 0
-                        no_of_lines = 0
-                    else:
-                        if symbol_length < 1000:  # just to avoid too wide lines. We bumped into a line with 57K and that disrupts the sd and hence thresholds
-                            no_of_lines += 1
-                            input_str = line.replace("\t", " ")
-                            cur_width = len(np.fromstring(input_str, dtype=np.int32, sep=" "))
-                            if cur_width > longest_line_length:
-                                longest_line_length = cur_width
-    return compute_max(widths, "width", z=z), compute_max(heights, "height", z=z)
+    widths, heights = length_histogram.folder_histogram_2d(path)
+    return length_histogram.compute_max(widths, "width", z=z), length_histogram.compute_max(heights, "height", z=z)
 
 
+# The outlier threshold of a list of lengths; see length_histogram.compute_max
 def compute_max(arr, dim="width", z=2):
-    mn = np.mean(arr, axis=0)
-    sd = np.std(arr, axis=0)
-    final_list = [x for x in arr if (x <= mn + z * sd)]  # upper outliers removed
-    rmn2 = len(arr) - len(final_list)
-    print('{} array size '.format(dim) + str(len(arr)))
-    print('min {} '.format(dim) + str(min(arr)))
-    print('max {} '.format(dim) + str(max(arr)))
-    print('mean {} '.format(dim) + str(np.nanmean(arr)))
-    print('standard deviation ' + str(np.std(arr)))
-    print('median {} '.format(dim) + str(np.nanmedian(arr)))
-    print('number of upper outliers removed ' + str(rmn2))
-    print('max {} excluding upper outliers '.format(dim) + str(max(final_list)))
-    return max(final_list)
-
-
-def remove_duplicates_1d(path):
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            if f.startswith("."):
-                continue
-            if f.endswith(".cld"):
-                continue  # its already processed.
-            filepath = os.path.join(root, f)
-            outfilepath = os.path.join(root, "temp.cld")
-            if os.path.exists(outfilepath):
-                os.remove(outfilepath)
-            mydict = dict()
-            with open(filepath, errors='ignore') as f:
-                for line in f:
-                    if line not in mydict:
-                        mydict[line] = line
-            with open(outfilepath, "w") as filewriter:
-                for value in mydict.values():
-                    filewriter.write(value)
-            os.remove(filepath)
-            os.rename(outfilepath, filepath + ".cld")
+    return length_histogram.compute_max(length_histogram.from_lengths(arr), dim, z)
+
 
+# Removes the lines seen before in any shard of the same label folder (see dedupe.py)
+def remove_duplicates_1d(path, digest_size=dedupe.DIGEST_SIZE,
+                         max_memory_fingerprints=dedupe.MAX_MEMORY_FINGERPRINTS):
+    return dedupe.dedupe_corpus(path, 1, digest_size, max_memory_fingerprints)
 
-def remove_duplicates_c2v(path):
-    mydict = dict()
+
+# Clusters the lines that differ in a few tokens only (see near_duplicates.py); with keep_representatives
+# only the first line of every cluster is kept
+def remove_near_duplicates_1d(path, keep_representatives=True, threshold=near_duplicates.THRESHOLD):
+    return near_duplicates.near_dedupe_corpus(path, keep_representatives, threshold=threshold)
+
+
+# Keeps the first occurrence of every vector line (by fingerprint, see dedupe.py) and writes the unique
+# lines to rolling samples<N>.cvec shards (see shard_writer.py)
+def remove_duplicates_c2v(path, digest_size=dedupe.DIGEST_SIZE,
+                          max_memory_fingerprints=dedupe.MAX_MEMORY_FINGERPRINTS):
     # for case in ['Positive', 'Negative']:
     for case in ['Negative']:
-        cur_dir_path = os.path.join(path, case)
-        for file in os.listdir(cur_dir_path):
-            if file.startswith("."):
-                continue
+        _remove_duplicates_c2v_folder(os.path.join(path, case), digest_size, max_memory_fingerprints)
+
+
+def _remove_duplicates_c2v_folder(cur_dir_path, digest_size=dedupe.DIGEST_SIZE,
+                                  max_memory_fingerprints=dedupe.MAX_MEMORY_FINGERPRINTS):
+    seen = dedupe.FingerprintSet(os.path.join(cur_dir_path, ".dedupe.sqlite"), max_memory_fingerprints)
+    writer = shard_writer.ShardWriter(cur_dir_path)
+    duplicates = 0
+    try:
+        for file in manifest.shard_files(cur_dir_path):
             if file.endswith(".cvec"):
                 continue  # its already processed.
-            filepath = os.path.join(cur_dir_path, file)
-            # outfilepath = os.path.join(root, "temp.cld")
-            # if os.path.exists(outfilepath):
-            #     os.remove(outfilepath)
-            with open(filepath, errors='ignore') as f:
-                for line in f:
-                    if line not in mydict:
-                        mydict[line] = line
-                    else:
-                        print('Duplicate found')
-            # os.remove(filepath)
-
-        outfilepath = get_out_file(cur_dir_path)
-        i = 0
-        for value in mydict.values():
-            with open(outfilepath, "a") as filewriter:
-                filewriter.write(value)
-                i += 1
-            if i > 1000:
-                i = 0
-                if is_file_oversize(outfilepath):
-                    outfilepath = get_out_file(cur_dir_path)
-            # os.rename(outfilepath, filepath + ".cld")
-
-
-def get_out_file(path):
-    i = 1
-    while True:
-        filepath = os.path.join(path, 'samples' + str(i) + '.cvec')
-        if not os.path.exists(filepath):
-            return filepath
-        i = i + 1
-
-
-def is_file_oversize(filename):
-    if os.path.getsize(filename) > 52428800:
-        return True
-    return False
-
-
-def remove_duplicates_2d(path):
-    for root, dirs, files in os.walk(path):
-        for f in files:
-            if f.startswith("."):
-                continue
-            if f.endswith(".cld"):
-                continue  # its already processed.
-            filepath = os.path.join(root, f)
-            outfilepath = os.path.join(root, "temp.cld")
-            if os.path.exists(outfilepath):
-                os.remove(outfilepath)
-
-            mydict = dict()
-            with open(filepath, errors='ignore') as f:
-                cur_sample = ""
-                for line in f:
-                    if len(line) > 1:
-                        cur_sample += line
-                    else:
-                        if not cur_sample in mydict:
-                            mydict[cur_sample] = cur_sample
-                        cur_sample = ""
-            with open(outfilepath, "w") as filewriter:
-                for value in mydict.values():
-                    filewriter.write(value + "\n")
-            os.remove(filepath)
-            os.rename(outfilepath, filepath + ".cld")
+            for line in dedupe.samples_1d(os.path.join(cur_dir_path, file)):
+                if seen.add(dedupe.fingerprint(line, digest_size)):
+                    writer.write(line + "\n")
+                else:
+                    duplicates += 1
+    finally:
+        writer.close()
+        seen.close()
+    print("\t" + cur_dir_path + ": " + str(len(seen)) + " unique vectors, " + str(duplicates) + " duplicates removed")
+
+
+# Removes the methods (blocks of lines) seen before in any shard of the same label folder (see dedupe.py)
+def remove_duplicates_2d(path, digest_size=dedupe.DIGEST_SIZE,
+                         max_memory_fingerprints=dedupe.MAX_MEMORY_FINGERPRINTS):
+    return dedupe.dedupe_corpus(path, 2, digest_size, max_memory_fingerprints)
+
+
+# Converts the Positive and Negative folders into binary token stores (see token_store.py).
+# It needs to be done once; get_data* read from the stores as long as the folders are unchanged.
+def build_token_store(data_path, is_c2v=False, dimension=1):
+    for case in ['Positive', 'Negative']:
+        folder_path = os.path.join(data_path, case)
+        if os.path.isdir(folder_path):
+            _build_folder_store(folder_path, is_c2v, dimension)
+
+
+def _build_folder_store(folder_path, is_c2v=False, dimension=1):
+    if dimension == 2:
+        if not token_store.is_store_2d_current(folder_path):
+            print("\tbuilding 2d token store for " + folder_path)
+            token_store.build_store_2d(folder_path)
+    elif not token_store.is_store_current(folder_path, is_c2v):
+        print("\tbuilding token store for " + folder_path)
+        token_store.build_store(folder_path, is_c2v)
 
 
 def preprocess_data_c2v(tokenizer_out_path):
     print("Preprocessing input data...")
-    print("\tRemoving duplicates...")
-    remove_duplicates_c2v(tokenizer_out_path)
+    for job in _c2v_jobs(tokenizer_out_path):
+        _preprocess_folder(*job)
     print("Preprocessing done.")
 
 
-def preprocess_data(tokenizer_out_path, dimension=1):
+# Only the Negative vectors are deduplicated (see remove_duplicates_c2v)
+def _c2v_jobs(tokenizer_out_path):
+    return [(os.path.join(tokenizer_out_path, case), "c2v", case == 'Negative') for case in ['Positive', 'Negative']
+            if os.path.isdir(os.path.join(tokenizer_out_path, case))]
+
+
+# The shards that went through the stages are recorded in a manifest in tokenizer_out_path (see manifest.py);
+# when none was added or changed since, deduplication and the empty file cleanup are skipped.
+# near_dedupe also removes the near duplicate lines of 1d inputs.
+def preprocess_data(tokenizer_out_path, dimension=1, near_dedupe=False):
     print("Preprocessing input data...")
-    # Only in case of 1d inputs; in 2d inputs we are not going to have this case in the inputs.
-    if dimension == 1:
-        # print("\tHandling overloaded methods...")
-        # handle_overloaded_methods(tokenizer_out_path)
-        print("\tRemoving duplicates...")
-        remove_duplicates_1d(tokenizer_out_path)
-    if dimension == 2:
-        print("\tRemoving duplicates...")
-        remove_duplicates_2d(tokenizer_out_path)
-    print("\tDeleting empty files...")
-    delete_empty_files(tokenizer_out_path)
+    corpus = _start_corpus(tokenizer_out_path, dimension, near_dedupe)
+    for folder in manifest.label_folders(tokenizer_out_path):
+        _preprocess_folder(folder, str(dimension) + "d", corpus[-1], near_dedupe)
+    _finish_corpus(*corpus)
+    print("Preprocessing done.")
+
+
+# Preprocesses the corpora of all the given smells and dims at once ("1d" and "2d" in
+# tokenizer_out_path/<smell>/<dim>, "c2v" directly in tokenizer_out_path/<smell>). The label folders of all of
+# them are processed on a pool of workers processes, largest first; every folder gets the same work as in
+# preprocess_data/_2d/_c2v, and the corpus wide steps (conflicts, manifest) follow once its folders are done.
+def preprocess_all(tokenizer_out_path, smells, dims, workers=None, near_dedupe=False):
+    if workers is None:
+        workers = PREPROCESS_WORKERS
+    print("Preprocessing input data...")
+    corpora = []
+    jobs = []
+    for smell in smells:
+        for dim in dims:
+            if dim == "c2v":
+                jobs += _c2v_jobs(os.path.join(tokenizer_out_path, smell))
+                continue
+            data_path = os.path.join(tokenizer_out_path, smell, dim)
+            corpus = _start_corpus(data_path, int(dim[0]), near_dedupe)
+            corpora.append(corpus)
+            jobs += [(folder, dim, corpus[-1], near_dedupe) for folder in manifest.label_folders(data_path)]
+    jobs.sort(key=lambda job: -sum(file[1] for file in token_store.folder_signature(job[0])))
+    _run_folder_jobs(jobs, workers)
+    for corpus in corpora:
+        _finish_corpus(*corpus)
     print("Preprocessing done.")
 
 
+def _preprocess_stages(dimension, near_dedupe):
+    stages = ["dedupe_" + str(dimension) + "d", "delete_empty"]
+    if near_dedupe and dimension == 1:
+        stages.append("near_dedupe_1d")
+    return stages
+
+
+# Removes the leftovers of interrupted runs and checks the manifest; the returned corpus tuple ends with
+# whether the shards need to be deduplicated
+def _start_corpus(tokenizer_out_path, dimension, near_dedupe):
+    manifest.remove_stale_temp_files(tokenizer_out_path)
+    preprocess_manifest = manifest.Manifest(tokenizer_out_path)
+    stages = _preprocess_stages(dimension, near_dedupe)
+    dedupe_needed = not preprocess_manifest.is_current(stages)
+    if not dedupe_needed:
+        print("\tNo new or changed shards in " + tokenizer_out_path)
+    return tokenizer_out_path, dimension, preprocess_manifest, stages, dedupe_needed
+
+
+# The work on one label folder: deduplication and empty file removal (when needed), the token store and
+# the length histograms, vocabulary and shard statistics. kind is "1d", "2d" or "c2v". With near_dedupe,
+# the shards are rewritten after the fused pass, so the 1d store is built a second time from all the shards.
+def _preprocess_folder(folder, kind, dedupe_needed, near_dedupe=False):
+    if kind == "c2v":
+        if dedupe_needed:
+            _remove_duplicates_c2v_folder(folder)
+        _build_folder_store(folder, is_c2v=True)
+        length_histogram.folder_histogram(folder, is_c2v=True)
+        corpus_stats.folder_stats(folder)
+        return
+    dimension = 2 if kind == "2d" else 1
+    if dedupe_needed and dimension == 1:
+        # Deduplication, empty shard removal and the token store in a single read of the new shards
+        fused_preprocess.preprocess_folder(folder)
+        if near_dedupe:
+            near_duplicates.near_dedupe_folder(folder)
+            delete_empty_files(folder)
+    elif dedupe_needed:
+        dedupe.dedupe_folder(folder, dimension)
+        delete_empty_files(folder)
+    _build_folder_store(folder, dimension=dimension)
+    if dimension == 2:
+        length_histogram.folder_histogram_2d(folder)
+    else:
+        length_histogram.folder_histogram(folder)
+    vocab_stats.folder_vocab(folder, dimension)
+    corpus_stats.folder_stats(folder)
+
+
+def _finish_corpus(tokenizer_out_path, dimension, preprocess_manifest, stages, dedupe_needed):
+    if dedupe_needed:
+        dedupe.find_conflicts(tokenizer_out_path, manifest.label_folders(tokenizer_out_path), dimension)
+        delete_empty_files(tokenizer_out_path)
+    preprocess_manifest.record(stages + ["store_" + str(dimension) + "d"], _store_outputs(tokenizer_out_path, dimension))
+
+
+# The workers parse the shards of their folder in their own process instead of starting a pool of their own
+def _single_process_worker():
+    token_store.PARSE_WORKERS = 1
+
+
+def _run_folder_jobs(jobs, workers):
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        for job in jobs:
+            _preprocess_folder(*job)
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=token_store.POOL_CONTEXT,
+                             initializer=_single_process_worker) as executor:
+        for future in [executor.submit(_preprocess_folder, *job) for job in jobs]:
+            future.result()
+
+
+def _store_outputs(tokenizer_out_path, dimension):
+    if dimension == 2:
+        names = [token_store.VALUES_2D_FILE, token_store.LINES_2D_FILE, token_store.SAMPLES_2D_FILE,
+                 token_store.META_2D_FILE]
+    else:
+        names = [token_store.VALUES_FILE, token_store.OFFSETS_FILE, token_store.META_FILE]
+    return {os.path.basename(folder): names for folder in manifest.label_folders(tokenizer_out_path)}
+
+
 def preprocess_data_2d(tokenizer_out_path):
     preprocess_data(tokenizer_out_path, 2)
 
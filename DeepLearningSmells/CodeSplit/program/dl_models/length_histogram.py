@@ -0,0 +1,170 @@
+import json
+import os
+from functools import partial
+import numpy as np
+import token_store
+
+# Sample length histograms for the outlier thresholds. counts[l] is the number of samples of length l,
+# so the mean/std cutoff of compute_max and the percentiles need memory in the number of distinct
+# lengths only. The histograms of a folder are cached in a hidden file inside it (skipped by the folder
+# walkers like the token stores) and recomputed only when the folder signature changes.
+HISTOGRAM_FILE = ".lengths.json"
+HISTOGRAM_2D_FILE = ".lengths2d.json"
+
+
+def from_lengths(lengths):
+    return np.bincount(np.asarray(lengths, dtype=np.int64), minlength=1)
+
+
+def merge(counts1, counts2):
+    if len(counts1) < len(counts2):
+        counts1, counts2 = counts2, counts1
+    merged = counts1.copy()
+    merged[:len(counts2)] += counts2
+    return merged
+
+
+def total(counts):
+    return int(counts.sum())
+
+
+def mean_std(counts):
+    values = np.arange(len(counts))
+    mn = np.dot(values, counts) / float(total(counts))
+    sd = np.sqrt(np.dot((values - mn) ** 2, counts) / float(total(counts)))
+    return mn, sd
+
+
+# Length at the given 0-based rank of the sorted lengths
+def _value_at(counts, rank):
+    return int(np.searchsorted(np.cumsum(counts), rank, side='right'))
+
+
+def median(counts):
+    n = total(counts)
+    if n % 2 == 1:
+        return float(_value_at(counts, n // 2))
+    return (_value_at(counts, n // 2 - 1) + _value_at(counts, n // 2)) / 2.0
+
+
+# Smallest length that is not shorter than q percent of the samples (nearest rank)
+def percentile(counts, q):
+    return _value_at(counts, max(int(np.ceil(q / 100.0 * total(counts))) - 1, 0))
+
+
+# Histogram version of the former inputs.compute_max: the longest length within z standard deviations
+# above the mean
+def compute_max(counts, dim="width", z=2):
+    n = total(counts)
+    if n == 0:
+        raise ValueError("no {} values to compute the outlier threshold from".format(dim))
+    mn, sd = mean_std(counts)
+    present = np.flatnonzero(counts)
+    kept = present[present <= mn + z * sd]
+    rmn2 = total(counts[kept[-1] + 1:])
+    print('{} array size '.format(dim) + str(n))
+    print('min {} '.format(dim) + str(present[0]))
+    print('max {} '.format(dim) + str(present[-1]))
+    print('mean {} '.format(dim) + str(mn))
+    print('standard deviation ' + str(sd))
+    print('median {} '.format(dim) + str(median(counts)))
+    print('number of upper outliers removed ' + str(rmn2))
+    print('max {} excluding upper outliers '.format(dim) + str(kept[-1]))
+    return int(kept[-1])
+
+
+def _shard_lengths(path, is_c2v=False):
+    lengths = []
+    with open(path, "r", errors='ignore') as file:
+        for line in file:
+            lengths.append(len(token_store.parse_line(line, is_c2v)))
+    return from_lengths(lengths)
+
+
+# Widths (longest line) and heights (number of lines) of the 2d samples of a shard, with the rules of the
+# former _get_outlier_threshold_2d
+def _shard_lengths_2d(path):
+    widths = []
+    heights = []
+    longest_line_length = 0
+    no_of_lines = 0
+    with open(path, "r", errors='ignore') as f:
+        for line in f:
+            symbol_length = len(line.split('\t'))
+            if len(line) < 2:  # which means current method ends here
+                widths.append(longest_line_length)
+                # in order to keep standard deviation low, removing very high number of lines
+                if no_of_lines < 2000:
+                    heights.append(no_of_lines)
+                longest_line_length = 0
+                no_of_lines = 0
+            else:
+                if symbol_length < 1000:  # just to avoid too wide lines. We bumped into a line with 57K and that disrupts the sd and hence thresholds
+                    no_of_lines += 1
+                    cur_width = len(token_store.parse_line(line))
+                    if cur_width > longest_line_length:
+                        longest_line_length = cur_width
+    return from_lengths(widths), from_lengths(heights)
+
+
+def _files(folder):
+    return [os.path.join(folder, file[0]) for file in token_store.folder_signature(folder)]
+
+
+def _load(path, signature, kind):
+    try:
+        with open(path, "r") as reader:
+            cached = json.load(reader)
+    except (OSError, ValueError):
+        return None
+    if cached.get("signature") != signature or cached.get("kind") != kind:
+        return None
+    return [np.array(counts, dtype=np.int64) for counts in cached["counts"]]
+
+
+def _save(path, signature, kind, histograms):
+    try:
+        with open(path + ".tmp", "w") as writer:
+            json.dump({"kind": kind, "signature": signature,
+                       "counts": [counts.tolist() for counts in histograms]}, writer)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        # A read only folder just means the histogram is recomputed next time
+        pass
+
+
+# Length histogram of the samples (lines) of a 1d folder. offsets of the already loaded samples avoid
+# reading the folder again when the cache is out of date.
+def folder_histogram(folder, is_c2v=False, offsets=None):
+    signature = token_store.folder_signature(folder)
+    path = os.path.join(folder, HISTOGRAM_FILE)
+    kind = "c2v" if is_c2v else "tokens"
+    cached = _load(path, signature, kind)
+    if cached is not None:
+        return cached[0]
+    if offsets is None and token_store.is_store_current(folder, is_c2v):
+        offsets = token_store.load_store(folder)[1]
+    if offsets is not None:
+        counts = from_lengths(token_store.sample_lengths(offsets))
+    else:
+        counts = from_lengths([])
+        for shard_counts in token_store.iter_shards(partial(_shard_lengths, is_c2v=is_c2v), _files(folder)):
+            counts = merge(counts, shard_counts)
+    _save(path, signature, kind, [counts])
+    return counts
+
+
+# Width and height histograms of a 2d folder
+def folder_histogram_2d(folder):
+    signature = token_store.folder_signature(folder)
+    path = os.path.join(folder, HISTOGRAM_2D_FILE)
+    cached = _load(path, signature, "2d")
+    if cached is not None:
+        return cached[0], cached[1]
+    widths = from_lengths([])
+    heights = from_lengths([])
+    for shard_widths, shard_heights in token_store.iter_shards(_shard_lengths_2d, _files(folder)):
+        widths = merge(widths, shard_widths)
+        heights = merge(heights, shard_heights)
+    _save(path, signature, "2d", [widths, heights])
+    return widths, heights
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+
+# Manifest of the shards of a tokenizer output folder: content hash, size, modification time and the
+# preprocessing stages applied to each shard. A shard whose size and mtime are unchanged is not hashed
+# or processed again, so a rerun over an unchanged corpus only stats the files. A shard with the same
+# size but a new mtime is hashed, and it is still unchanged when its content hash is the recorded one.
+PREPROCESS_MANIFEST = ".preprocess_manifest.json"
+HASH_CHUNK = 1 << 20
+# Leftovers of interrupted runs: the temp files of the former per-file deduplication and of dedupe.py, and
+# the "<output>.tmp" files the stages write before renaming their output into place (see _is_temp_file)
+STALE_TEMP_FILES = ["temp.cld", ".dedupe.tmp"]
+TEMP_SUFFIX = ".tmp"
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as reader:
+        for chunk in iter(lambda: reader.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_json(path):
+    try:
+        with open(path, "r") as reader:
+            return json.load(reader)
+    except (OSError, ValueError):
+        return None
+
+
+# Writes to a temp file first, so that the file is either the old or the new version after a crash
+def write_json(path, obj):
+    with open(path + TEMP_SUFFIX, "w") as writer:
+        json.dump(obj, writer, indent=1, sort_keys=True)
+    os.replace(path + TEMP_SUFFIX, path)
+
+
+# Positive and Negative when the folder has them, otherwise the folder itself
+def label_folders(path):
+    folders = [os.path.join(path, case) for case in ['Positive', 'Negative']
+               if os.path.isdir(os.path.join(path, case))]
+    if len(folders) == 0:
+        folders = [path]
+    return folders
+
+
+def shard_files(folder):
+    return sorted(f for f in os.listdir(folder)
+                  if not f.startswith(".") and os.path.isfile(os.path.join(folder, f)))
+
+
+# (manifest key, path) of every shard of the label folders of path
+def corpus_shards(path):
+    shards = []
+    for folder in label_folders(path):
+        for shard in shard_files(folder):
+            filepath = os.path.join(folder, shard)
+            shards.append((os.path.relpath(filepath, path).replace(os.sep, "/"), filepath))
+    return shards
+
+
+# A temp file of the preprocessing: one of STALE_TEMP_FILES, "<name>.tmp" of a hidden output (stores, caches,
+# sidecars) or "<shard>.tmp" next to the shard it rewrites
+def _is_temp_file(folder, f):
+    if f in STALE_TEMP_FILES:
+        return True
+    if not f.endswith(TEMP_SUFFIX):
+        return False
+    output = f[:-len(TEMP_SUFFIX)]
+    return output.startswith(".") or os.path.isfile(os.path.join(folder, output))
+
+
+# Removes the temp files of the preprocessing left in path and its label folders
+def remove_stale_temp_files(path):
+    for folder in sorted(set([path] + label_folders(path))):
+        for f in os.listdir(folder):
+            if os.path.isfile(os.path.join(folder, f)) and _is_temp_file(folder, f):
+                print("\tremoving leftover " + os.path.join(folder, f))
+                os.remove(os.path.join(folder, f))
+
+
+class Manifest:
+    def __init__(self, path, name=PREPROCESS_MANIFEST):
+        self.path = os.path.join(path, name)
+        self.root = path
+        self.data = read_json(self.path)
+        if self.data is None:
+            self.data = {"shards": {}}
+
+    def _is_unchanged(self, key, filepath):
+        entry = self.data["shards"].get(key)
+        if entry is None:
+            return False
+        stat = os.stat(filepath)
+        if entry["size"] != stat.st_size:
+            return False
+        return entry["mtime_ns"] == stat.st_mtime_ns or entry["hash"] == file_hash(filepath)
+
+    # True when the shards are exactly the recorded ones, unchanged and through all the given stages
+    def is_current(self, stages):
+        shards = corpus_shards(self.root)
+        if len(shards) != len(self.data["shards"]):
+            return False
+        for key, filepath in shards:
+            if not self._is_unchanged(key, filepath) or not set(stages) <= set(self.data["shards"][key]["stages"]):
+                return False
+        return True
+
+    # Records the current shards of the folder after the given stages; only new, changed or touched shards
+    # are hashed. A touched shard keeps its stages with its new mtime.
+    def record(self, stages, outputs=None):
+        shards = {}
+        for key, filepath in corpus_shards(self.root):
+            entry = self.data["shards"].get(key)
+            stat = os.stat(filepath)
+            if self._is_unchanged(key, filepath):
+                entry = dict(entry, mtime_ns=stat.st_mtime_ns)
+            else:
+                entry = {"hash": file_hash(filepath), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                         "stages": []}
+            entry["stages"] = sorted(set(entry["stages"]) | set(stages))
+            shards[key] = entry
+        self.data["shards"] = shards
+        if outputs is not None:
+            self.data["outputs"] = outputs
+        write_json(self.path, self.data)
@@ -4,13 +4,17 @@ from sklearn.metrics import f1_score
 from sklearn.metrics import average_precision_score
 from sklearn.metrics import roc_curve
 from sklearn.metrics import auc
+import data_sequence
 
 def get_all_metrics(model, eval_data, eval_labels, pred_labels):
     fpr, tpr, thresholds_keras = roc_curve(eval_labels, pred_labels)
     auc_ = auc(fpr, tpr)
     print("auc_keras:" + str(auc_))
 
-    score = model.evaluate(eval_data, eval_labels, verbose=0)
+    if isinstance(eval_data, data_sequence.SampleSequence):
+        score = model.evaluate(eval_data, verbose=0)
+    else:
+        score = model.evaluate(eval_data, eval_labels, verbose=0)
     print("Test accuracy: " + str(score[1]))
 
     precision = precision_score(eval_labels, pred_labels)
@@ -0,0 +1,148 @@
+import os
+import numpy as np
+import manifest
+import token_store
+
+# Near-duplicate detection for the 1d token sequences with MinHash and LSH. Every sample is reduced to
+# NUM_PERM minimum hashes of its shingles (SHINGLE_SIZE consecutive tokens); two samples share a given
+# minimum hash with a probability equal to the Jaccard similarity of their shingle sets. The signatures
+# are cut into BANDS bands and the samples with an identical band fall in the same bucket. Every pair of
+# samples of a bucket is compared (in a bucket larger than MAX_BUCKET, every sample with the MAX_BUCKET - 1
+# samples before it only) and kept when the fraction of equal minimum hashes reaches THRESHOLD. Clusters are
+# the connected components of the kept pairs, so no pair of samples is compared unless it collides in some band.
+SHINGLE_SIZE = 3
+NUM_PERM = 128
+BANDS = 16  # 8 rows per band; pairs with a similarity of about (1 / BANDS) ** (1 / rows) = 0.71 collide half the time
+THRESHOLD = 0.8
+SEED = 42
+# Bucket size up to which all the pairs of a bucket are compared; it bounds the cost of very common bands
+MAX_BUCKET = 100
+# Number of samples hashed at a time; it bounds the size of the temporary shingle arrays
+SIGNATURE_CHUNK = 65536
+
+# Shingles and permutations are hashed modulo a Mersenne prime below 2 ** 31, so every product fits in 64 bits
+_PRIME = (1 << 31) - 1
+_BASE = 1000003
+
+
+def _permutations(num_perm, seed):
+    rng = np.random.RandomState(seed)
+    return rng.randint(1, _PRIME, size=num_perm).astype(np.int64), \
+        rng.randint(0, _PRIME, size=num_perm).astype(np.int64)
+
+
+# Hash of every shingle of the given samples and the index of the first shingle of each sample.
+# A sample shorter than shingle_size is a single shingle; positions beyond its end hash as 0.
+def _shingle_hashes(values, offsets, samples, shingle_size):
+    starts = offsets[samples]
+    lengths = offsets[samples + 1] - starts
+    counts = np.maximum(lengths - shingle_size + 1, 1)
+    positions = np.repeat(starts, counts) + token_store._range_positions(counts)
+    ends = np.repeat(starts + lengths, counts)
+    hashes = np.zeros(len(positions), dtype=np.int64)
+    for j in range(shingle_size):
+        inside = positions + j < ends
+        tokens = np.zeros(len(positions), dtype=np.int64)
+        tokens[inside] = values[positions[inside] + j] % _PRIME + 1
+        hashes = (hashes * _BASE + tokens) % _PRIME
+    return hashes, np.cumsum(counts) - counts
+
+
+# MinHash signatures (samples, num_perm) of the samples of a ragged (values, offsets) pair
+def signatures(values, offsets, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=SEED):
+    a, b = _permutations(num_perm, seed)
+    n = len(offsets) - 1
+    result = np.empty((n, num_perm), dtype=np.uint32)
+    for start in range(0, n, SIGNATURE_CHUNK):
+        samples = np.arange(start, min(start + SIGNATURE_CHUNK, n))
+        hashes, first = _shingle_hashes(values, offsets, samples, shingle_size)
+        for p in range(num_perm):
+            result[samples, p] = np.minimum.reduceat((a[p] * hashes + b[p]) % _PRIME, first)
+    return result
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _union_pairs(parent, firsts, seconds):
+    for i, j in zip(firsts, seconds):
+        root_i, root_j = _find(parent, i), _find(parent, j)
+        # The smaller index becomes the root, so the root is the first sample of the cluster
+        if root_i < root_j:
+            parent[root_j] = root_i
+        elif root_j < root_i:
+            parent[root_i] = root_j
+
+
+# Cluster label of every sample: the index of the first sample of its cluster. Two samples with at least
+# threshold equal minimum hashes end in the same cluster when they share a band bucket of at most
+# max_bucket samples (or are less than max_bucket apart in a larger one).
+def cluster(sigs, bands=BANDS, threshold=THRESHOLD, max_bucket=MAX_BUCKET):
+    n, num_perm = sigs.shape
+    rows = num_perm // bands
+    parent = list(range(n))
+    for band in range(bands):
+        keys = np.ascontiguousarray(sigs[:, band * rows:(band + 1) * rows]).view(np.dtype((np.void, rows * 4)))
+        _, inverse, counts = np.unique(keys.ravel(), return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        # The samples sorted by bucket; a pair d apart in this order is in the same bucket when its keys match
+        order = np.argsort(inverse, kind='stable')
+        buckets = inverse[order]
+        for distance in range(1, min(int(counts.max(initial=1)), max_bucket)):
+            same = np.flatnonzero(buckets[distance:] == buckets[:-distance])
+            for start in range(0, len(same), SIGNATURE_CHUNK):
+                chunk = same[start:start + SIGNATURE_CHUNK]
+                firsts = order[chunk]
+                seconds = order[chunk + distance]
+                similar = np.mean(sigs[firsts] == sigs[seconds], axis=1) >= threshold
+                _union_pairs(parent, firsts[similar].tolist(), seconds[similar].tolist())
+    return np.array([_find(parent, i) for i in range(n)], dtype=np.int64)
+
+
+# True for the one sample kept per cluster (its first one)
+def representatives(labels):
+    return labels == np.arange(len(labels))
+
+
+def folder_clusters(folder, is_c2v=False, bands=BANDS, threshold=THRESHOLD):
+    if not token_store.is_store_current(folder, is_c2v):
+        token_store.build_store(folder, is_c2v)
+    values, offsets = token_store.load_store(folder)
+    return cluster(signatures(values, offsets), bands, threshold)
+
+
+# Rewrites the shards of the folder with only the samples where keep is True; keep follows the order
+# of the samples in the token store
+def _keep_samples(folder, keep):
+    i = 0
+    for shard in token_store._source_files(folder):
+        filepath = os.path.join(folder, shard)
+        with open(filepath, "r", errors='ignore') as reader, open(filepath + manifest.TEMP_SUFFIX, "w") as writer:
+            for line in reader:
+                if keep[i]:
+                    writer.write(line)
+                i += 1
+        os.replace(filepath + manifest.TEMP_SUFFIX, filepath)
+
+
+# Clusters the near-duplicate samples of a folder. With keep_representatives, only the first sample of
+# every cluster is kept in the shards. Returns the cluster labels.
+def near_dedupe_folder(folder, keep_representatives=True, bands=BANDS, threshold=THRESHOLD):
+    labels = folder_clusters(folder, bands=bands, threshold=threshold)
+    keep = representatives(labels)
+    print("\t" + folder + ": " + str(len(labels)) + " samples in " + str(int(keep.sum())) + " clusters")
+    if keep_representatives and not keep.all():
+        _keep_samples(folder, keep)
+    return labels
+
+
+# near_dedupe_folder for every label folder of path; returns the cluster labels per label folder
+def near_dedupe_corpus(path, keep_representatives=True, bands=BANDS, threshold=THRESHOLD):
+    clusters = {}
+    for folder in manifest.label_folders(path):
+        clusters[os.path.basename(folder)] = near_dedupe_folder(folder, keep_representatives, bands, threshold)
+    return clusters
@@ -0,0 +1,17 @@
+import inputs
+
+# --- Parameters --
+# TOKENIZER_OUT_PATH = "../../data/tokenizer_out_cs/"
+TOKENIZER_OUT_PATH = "/users/pa18/tushar/smellDetectionML/data/tokenizer_out/"
+# C2V_OUT_PATH = r"..\..\data\c2v_vectors"
+C2V_OUT_PATH = "/users/pa18/tushar/smellDetectionML/data/c2v_vectors/"
+SMELLS = ["ComplexConditional", "ComplexMethod", "MultifacetedAbstraction", "FeatureEnvy"]
+DIMS = ["1d", "2d"]
+C2V = False  # Whether the Code2Vec vectors of the smells are preprocessed as well
+WORKERS = inputs.PREPROCESS_WORKERS
+# ---
+
+if __name__ == "__main__":
+    inputs.preprocess_all(TOKENIZER_OUT_PATH, SMELLS, DIMS, WORKERS)
+    if C2V:
+        inputs.preprocess_all(C2V_OUT_PATH, SMELLS, ["c2v"], WORKERS)
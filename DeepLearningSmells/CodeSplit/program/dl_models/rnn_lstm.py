@@ -10,6 +10,8 @@ import os
 import configuration
 import input_data
 import inputs
+import data_sequence
+import vocab_stats
 import datetime
 import numpy as np
 import gc
@@ -31,12 +33,21 @@ EVAL_TOKENIZER_OUT_PATH = "../../data/tokenizer_out_java/"
 
 TRAIN_VALIDATE_RATIO = 0.7
 CLASSIFIER_THRESHOLD = 0.7
+STREAMING = False # Read the batches lazily from the token store (data_sequence.py) instead of loading all samples in memory
+BUCKETING = False # Stream batches of samples with similar lengths, padded only to their longest sample (implies STREAMING)
+VOCAB_SIZE = None # Most frequent token ids kept for the Embedding; the others share an out of vocabulary id
 # ---
 
 
 def embedding_lstm(rq1_data, rq2_data, config, smell, rq1_out_folder=RQ1_OUT_FOLDER, rq2_out_folder = RQ2_OUT_FOLDER, dim = DIM):
     tf.keras.backend.clear_session()
-    max_features = int(max(np.max(rq1_data.train_data), np.max(rq1_data.eval_data)))
+    streaming = isinstance(rq1_data.train_data, data_sequence.SampleSequence)
+    if rq1_data.max_features is not None:
+        max_features = rq1_data.max_features
+    elif streaming:
+        max_features = max(rq1_data.train_data.max_value(), rq1_data.eval_data.max_value())
+    else:
+        max_features = int(max(np.max(rq1_data.train_data), np.max(rq1_data.eval_data)))
     print("max features: " + str(max_features))
 
     model = tf.keras.models.Sequential()
@@ -71,12 +82,16 @@ def embedding_lstm(rq1_data, rq2_data, config, smell, rq1_out_folder=RQ1_OUT_FOL
     if b_size > len(batch_sizes) - 1:
         b_size = len(batch_sizes) - 1
 
-    model.fit(rq1_data.train_data,
-                        rq1_data.train_labels,
-                        validation_split=0.2,
-                        epochs=config.epochs,
-                        batch_size=batch_sizes[b_size],
-                        callbacks=callbacks_list)
+    if streaming:
+        data_sequence.fit(model, rq1_data.train_data, config.epochs, batch_sizes[b_size], validation_split=0.2,
+                          callbacks=callbacks_list)
+    else:
+        model.fit(rq1_data.train_data,
+                            rq1_data.train_labels,
+                            validation_split=0.2,
+                            epochs=config.epochs,
+                            batch_size=batch_sizes[b_size],
+                            callbacks=callbacks_list)
     # y_pred = model.predict(data.eval_data).ravel()
 
     stopped_epoch = earlystop.stopped_epoch
@@ -113,22 +128,45 @@ def start_training(data, config, conn, smell):
 
 def get_all_data(data_path, rq2_eval_data_path, smell):
     print("reading data...")
+    # The model trained on the rq1 data predicts the rq2 eval samples too
+    max_features = vocab_stats.max_features(data_path, rq2_eval_data_path, vocab_size=VOCAB_SIZE)
+
+    if STREAMING or BUCKETING:
+        train_data, eval_data, max_input_length = \
+            data_sequence.get_data_sequences(data_path, train_validate_ratio=TRAIN_VALIDATE_RATIO,
+                                             max_training_samples=5000, shuffle=True, channel=False,
+                                             token_ids=True, vocab_size=VOCAB_SIZE, bucket_by_length=BUCKETING)
+        rq1_data = input_data.Input_data(train_data, train_data.labels, eval_data, eval_data.labels, max_input_length,
+                                         max_features)
+        # The model is trained on the rq1 data only; rq2 provides the eval sequence
+        training_data, eval_data, max_input_length = \
+            data_sequence.get_data_rq2_sequences(data_path, rq2_eval_data_path, RQ2_OUT_FOLDER, "rq2_rnn_" + smell,
+                                                 train_validate_ratio=TRAIN_VALIDATE_RATIO,
+                                                 max_training_samples=5000, channel=False, token_ids=True,
+                                                 vocab_size=VOCAB_SIZE, bucket_by_length=BUCKETING)
+        rq2_data = input_data.Input_data(training_data, training_data.labels, eval_data, eval_data.labels,
+                                         max_input_length, max_features)
+        print("reading data... done.")
+        return rq1_data, rq2_data
 
     train_data, train_labels, eval_data, eval_labels, max_input_length = \
         inputs.get_data(data_path, RQ1_OUT_FOLDER, "rq1_rnn_" + smell,
-                                                train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples= 5000)
+                                                train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples= 5000,
+                                                token_ids=True, vocab_size=VOCAB_SIZE)
 
     train_data = train_data.reshape((len(train_labels), max_input_length))
     eval_data = eval_data.reshape((len(eval_labels), max_input_length))
-    rq1_data = input_data.Input_data(train_data, train_labels, eval_data, eval_labels, max_input_length)
+    rq1_data = input_data.Input_data(train_data, train_labels, eval_data, eval_labels, max_input_length, max_features)
 
     training_data, training_labels, eval_data, eval_labels, max_input_length = \
         inputs.get_data_rq2(data_path, rq2_eval_data_path, RQ2_OUT_FOLDER, "rq2_rnn_" + smell,
-                        train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000)
+                        train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000, token_ids=True,
+                        vocab_size=VOCAB_SIZE)
 
     training_data = training_data.reshape((len(training_labels), max_input_length))
     eval_data = eval_data.reshape((len(eval_labels), max_input_length))
-    rq2_data = input_data.Input_data(training_data, training_labels, eval_data, eval_labels, max_input_length)
+    rq2_data = input_data.Input_data(training_data, training_labels, eval_data, eval_labels, max_input_length,
+                                     max_features)
     print("reading data... done.")
 
     return rq1_data, rq2_data
@@ -6,6 +6,7 @@ import tensorflow as tf
 import os
 import configuration, input_data
 import inputs
+import data_sequence
 import time
 import datetime
 import plot_util
@@ -16,6 +17,7 @@ from sklearn.dummy import DummyClassifier
 # -- Parameters --
 DIM = "1d"
 C2V = True # It means whether we are analyzing plain source code that is tokenized (False) or vectors from Code2Vec (True)
+STREAMING = False # Read the batches lazily from the token store (data_sequence.py) instead of loading all samples in memory
 
 if C2V:
     # TOKENIZER_OUT_PATH = "/users/pa18/tushar/smellDetectionML/data/c2v_vectors/"
@@ -73,14 +75,22 @@ def cnn(data, config, smell, out_folder=OUT_FOLDER, dim=DIM, is_final=False):
     if b_size > len(batch_sizes) - 1:
         b_size = len(batch_sizes) - 1
 
+    streaming = isinstance(data.train_data, data_sequence.SampleSequence)
     if is_final:
-        model.fit(data.train_data, data.train_labels, epochs=config.epochs, batch_size=batch_sizes[b_size],
-                  verbose=1, shuffle=False)
+        if streaming:
+            data_sequence.fit(model, data.train_data, config.epochs, batch_sizes[b_size])
+        else:
+            model.fit(data.train_data, data.train_labels, epochs=config.epochs, batch_size=batch_sizes[b_size],
+                      verbose=1, shuffle=False)
         stopped_epoch = config.epochs
     else:
-        model.fit(data.train_data, data.train_labels, validation_split=0.2, epochs=config.epochs,
-                  batch_size=batch_sizes[b_size],
-                  callbacks=callbacks_list, verbose=1, shuffle=False)
+        if streaming:
+            data_sequence.fit(model, data.train_data, config.epochs, batch_sizes[b_size], validation_split=0.2,
+                              callbacks=callbacks_list)
+        else:
+            model.fit(data.train_data, data.train_labels, validation_split=0.2, epochs=config.epochs,
+                      batch_size=batch_sizes[b_size],
+                      callbacks=callbacks_list, verbose=1, shuffle=False)
         stopped_epoch = earlystop.stopped_epoch
         model.load_weights(best_model_filepath)
 
@@ -111,10 +121,18 @@ def get_all_data(data_path, smell):
         max_eval_samples = 50000 #for design smells (classes)
 
     # Load training and eval data
-    train_data, train_labels, eval_data, eval_labels, max_input_length = \
-        inputs.get_data(data_path,
-                        train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000,
-                        max_eval_samples=max_eval_samples, is_c2v = C2V)
+    if STREAMING:
+        train_data, eval_data, max_input_length = \
+            data_sequence.get_data_sequences(data_path,
+                                             train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000,
+                                             max_eval_samples=max_eval_samples, is_c2v=C2V)
+        train_labels = train_data.labels
+        eval_labels = eval_data.labels
+    else:
+        train_data, train_labels, eval_data, eval_labels, max_input_length = \
+            inputs.get_data(data_path,
+                            train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000,
+                            max_eval_samples=max_eval_samples, is_c2v = C2V)
 
     # train_data = train_data.reshape((len(train_labels), max_input_length))
     # eval_data = eval_data.reshape((len(eval_labels), max_input_length))
@@ -7,6 +7,7 @@ import os
 import tensorflow as tf
 import configuration, input_data
 import inputs
+import data_sequence
 import plot_util
 import time
 import metrics_util
@@ -23,15 +24,32 @@ OUT_FOLDER = "/users/pa18/tushar/smellDetectionML/program/results/rq1/raw"
 
 TRAIN_VALIDATE_RATIO = 0.7
 CLASSIFIER_THRESHOLD = 0.7
+RAGGED = False # Keep the samples ragged and pad each batch only to its largest sample (data_sequence.Sample2dSequence)
 # ------------
 
 
+# Smallest input side for which every Conv2D + MaxPooling2D block of the model still has an output
+def _min_input_size(config):
+    size = 1
+    for i in range(config.layers):
+        size = 2 * (size - 1) + config.pooling_window + config.kernel - 1
+    return size
+
+
 def cnn(data, config, smell, out_folder=OUT_FOLDER, dim=DIM, is_final = False):
     assert (config.layers >= 1 and config.layers <= 3)
 
+    # With ragged batches the height and width of the input change from batch to batch
+    ragged = isinstance(data.train_data, data_sequence.Sample2dSequence)
+    input_shape = (data.max_input_height, data.max_input_width, 1)
+    if ragged:
+        input_shape = (None, None, 1)
+        for sequence in [data.train_data, data.eval_data]:
+            sequence.min_height = sequence.min_width = _min_input_size(config)
+
     model = tf.keras.models.Sequential()
     model.add(tf.keras.layers.Conv2D(config.filters, config.kernel, activation='relu',
-                                     input_shape=(data.max_input_height, data.max_input_width, 1),
+                                     input_shape=input_shape,
                                      bias_initializer='zeros',
                                      kernel_initializer='random_uniform'
                                      ))
@@ -43,7 +61,10 @@ def cnn(data, config, smell, out_folder=OUT_FOLDER, dim=DIM, is_final = False):
         model.add(tf.keras.layers.MaxPooling2D(config.pooling_window, strides=2))
         # model.add(tf.keras.layers.Dropout(rate=0.1))
     model.add(tf.keras.layers.SpatialDropout2D(rate=0.1))
-    model.add(tf.keras.layers.Flatten())
+    if ragged:
+        model.add(tf.keras.layers.GlobalMaxPooling2D())
+    else:
+        model.add(tf.keras.layers.Flatten())
     model.add(tf.keras.layers.Dense(32, activation='relu'))
     model.add(tf.keras.layers.Dense(1, activation='sigmoid'))
     model.compile(optimizer='adam',
@@ -67,12 +88,19 @@ def cnn(data, config, smell, out_folder=OUT_FOLDER, dim=DIM, is_final = False):
         b_size = len(batch_sizes) - 1
 
     if is_final:
-        model.fit(data.train_data, data.train_labels, epochs=config.epochs, batch_size=batch_sizes[b_size],
-            verbose=1, shuffle=False)
+        if ragged:
+            data_sequence.fit(model, data.train_data, config.epochs, batch_sizes[b_size])
+        else:
+            model.fit(data.train_data, data.train_labels, epochs=config.epochs, batch_size=batch_sizes[b_size],
+                verbose=1, shuffle=False)
         stopped_epoch = config.epochs
     else:
-        model.fit(data.train_data, data.train_labels, validation_split=0.2, epochs=config.epochs, batch_size=batch_sizes[b_size],
-              callbacks=callbacks_list, verbose=1, shuffle=False)
+        if ragged:
+            data_sequence.fit(model, data.train_data, config.epochs, batch_sizes[b_size], validation_split=0.2,
+                              callbacks=callbacks_list)
+        else:
+            model.fit(data.train_data, data.train_labels, validation_split=0.2, epochs=config.epochs, batch_size=batch_sizes[b_size],
+                  callbacks=callbacks_list, verbose=1, shuffle=False)
         stopped_epoch = earlystop.stopped_epoch
         model.load_weights(best_model_filepath)
 
@@ -95,9 +123,16 @@ def get_all_data(data_path, smell):
     print("reading data...")
 
     # Load training and eval data
-    train_data, train_labels, eval_data, eval_labels, max_input_height, max_input_width = \
-        inputs.get_data_2d(data_path, OUT_FOLDER, "rq1_cnn2d_" + smell,
-                           train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000)
+    if RAGGED:
+        train_data, eval_data, max_input_height, max_input_width = \
+            data_sequence.get_data_2d_sequences(data_path, OUT_FOLDER, "rq1_cnn2d_" + smell,
+                                                train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000)
+        train_labels = train_data.labels
+        eval_labels = eval_data.labels
+    else:
+        train_data, train_labels, eval_data, eval_labels, max_input_height, max_input_width = \
+            inputs.get_data_2d(data_path, OUT_FOLDER, "rq1_cnn2d_" + smell,
+                               train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000)
 
     print("reading data... done.")
     # just for dummy classifier
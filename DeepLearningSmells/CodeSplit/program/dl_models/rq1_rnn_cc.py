@@ -14,11 +14,12 @@ else:
     TOKENIZER_OUT_PATH = "/users/pa18/tushar/smellDetectionML/data/c2v_vectors/"
 # ---
 
-smell = "ComplexConditional"
-if C2V:
-    data_path = os.path.join(TOKENIZER_OUT_PATH, smell)
-    inputs.preprocess_data_c2v(data_path)
-else:
-    data_path = os.path.join(TOKENIZER_OUT_PATH, smell, DIM)
-    inputs.preprocess_data(data_path)
-rnn.main(data_path, smell)
\ No newline at end of file
+if __name__ == "__main__":
+    smell = "ComplexConditional"
+    if C2V:
+        data_path = os.path.join(TOKENIZER_OUT_PATH, smell)
+        inputs.preprocess_data_c2v(data_path)
+    else:
+        data_path = os.path.join(TOKENIZER_OUT_PATH, smell, DIM)
+        inputs.preprocess_data(data_path)
+    rnn.main(data_path, smell)
\ No newline at end of file
@@ -7,6 +7,8 @@ import os
 import configuration
 import input_data
 import inputs
+import data_sequence
+import vocab_stats
 import datetime
 import numpy as np
 import gc
@@ -18,6 +20,9 @@ from sklearn.dummy import DummyClassifier
 # --- Parameters --
 DIM = "1d"
 C2V = True # It means whether we are analyzing plain source code that is tokenized (False) or vectors from Code2Vec (True)
+STREAMING = False # Read the batches lazily from the token store (data_sequence.py) instead of loading all samples in memory
+BUCKETING = False # Stream batches of samples with similar lengths, padded only to their longest sample (implies STREAMING)
+VOCAB_SIZE = None # Most frequent token ids kept for the Embedding; the others share an out of vocabulary id
 
 if C2V:
     # TOKENIZER_OUT_PATH = "/users/pa18/tushar/smellDetectionML/data/c2v_vectors/"
@@ -39,7 +44,13 @@ CLASSIFIER_THRESHOLD = 0.7
 
 def embedding_lstm(data, config, smell, out_folder=OUT_FOLDER, dim=DIM, iteration=0, is_final=False):
     tf.keras.backend.clear_session()
-    max_features = int(max(np.max(data.train_data), np.max(data.eval_data)))
+    streaming = isinstance(data.train_data, data_sequence.SampleSequence)
+    if data.max_features is not None:
+        max_features = data.max_features
+    elif streaming:
+        max_features = max(data.train_data.max_value(), data.eval_data.max_value())
+    else:
+        max_features = int(max(np.max(data.train_data), np.max(data.eval_data)))
     print("max features: " + str(max_features))
 
     model = tf.keras.models.Sequential()
@@ -75,19 +86,26 @@ def embedding_lstm(data, config, smell, out_folder=OUT_FOLDER, dim=DIM, iteratio
         b_size = len(batch_sizes) - 1
 
     if is_final:
-        model.fit(data.train_data,
-                  data.train_labels,
-                  epochs=config.epochs,
-                  batch_size=batch_sizes[b_size])
+        if streaming:
+            data_sequence.fit(model, data.train_data, config.epochs, batch_sizes[b_size])
+        else:
+            model.fit(data.train_data,
+                      data.train_labels,
+                      epochs=config.epochs,
+                      batch_size=batch_sizes[b_size])
         stopped_epoch = config.epochs
 
     else:
-        model.fit(data.train_data,
-                  data.train_labels,
-                  validation_split=0.2,
-                  epochs=config.epochs,
-                  batch_size=batch_sizes[b_size],
-                  callbacks=callbacks_list)
+        if streaming:
+            data_sequence.fit(model, data.train_data, config.epochs, batch_sizes[b_size], validation_split=0.2,
+                              callbacks=callbacks_list)
+        else:
+            model.fit(data.train_data,
+                      data.train_labels,
+                      validation_split=0.2,
+                      epochs=config.epochs,
+                      batch_size=batch_sizes[b_size],
+                      callbacks=callbacks_list)
         stopped_epoch = earlystop.stopped_epoch
         model.load_weights(best_model_filepath)
 
@@ -118,21 +136,34 @@ def start_training(data, config, conn, smell):
 
 def get_all_data(data_path, smell):
     print("reading data...")
+    max_features = None if C2V else vocab_stats.max_features(data_path, vocab_size=VOCAB_SIZE)
 
     if smell in ["ComplexConditional", "ComplexMethod"]:
         max_eval_samples = 150000  # for impl smells (methods)
     else:
         max_eval_samples = 50000  # for design smells (classes)
 
+    if STREAMING or BUCKETING:
+        # model.fit shuffles the in-memory training data every epoch; the sequence does the same
+        train_data, eval_data, max_input_length = \
+            data_sequence.get_data_sequences(data_path,
+                                             train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000,
+                                             max_eval_samples=max_eval_samples, is_c2v=C2V,
+                                             shuffle=True, channel=False, token_ids=True, vocab_size=VOCAB_SIZE,
+                                             bucket_by_length=BUCKETING)
+        print("reading data... done.")
+        return input_data.Input_data(train_data, train_data.labels, eval_data, eval_data.labels, max_input_length,
+                                     max_features)
+
     train_data, train_labels, eval_data, eval_labels, max_input_length = \
         inputs.get_data(data_path,
                         train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000,
-                        max_eval_samples=max_eval_samples, is_c2v=C2V)
+                        max_eval_samples=max_eval_samples, is_c2v=C2V, token_ids=True, vocab_size=VOCAB_SIZE)
 
     train_data = train_data.reshape((len(train_labels), max_input_length))
     eval_data = eval_data.reshape((len(eval_labels), max_input_length))
     print("reading data... done.")
-    return input_data.Input_data(train_data, train_labels, eval_data, eval_labels, max_input_length)
+    return input_data.Input_data(train_data, train_labels, eval_data, eval_labels, max_input_length, max_features)
 
 
 def write_result(file, str):
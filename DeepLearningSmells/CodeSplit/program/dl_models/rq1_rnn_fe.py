@@ -9,7 +9,8 @@ DIM = "1d"
 TOKENIZER_OUT_PATH = "/users/pa18/tushar/smellDetectionML/data/tokenizer_out/"
 # ---
 
-smell = "FeatureEnvy"
-data_path = os.path.join(os.path.join(TOKENIZER_OUT_PATH, smell), DIM)
-inputs.preprocess_data(data_path)
-rnn.main(data_path, smell, skip_iter=9)
+if __name__ == "__main__":
+    smell = "FeatureEnvy"
+    data_path = os.path.join(os.path.join(TOKENIZER_OUT_PATH, smell), DIM)
+    inputs.preprocess_data(data_path)
+    rnn.main(data_path, smell, skip_iter=9)
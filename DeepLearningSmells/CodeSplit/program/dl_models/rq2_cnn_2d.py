@@ -6,6 +6,7 @@ import datetime
 import os
 import configuration, input_data
 import inputs
+import data_sequence
 import rq1_cnn_2d
 import time
 
@@ -30,14 +31,23 @@ else:
     OUT_FOLDER = "/users/pa18/tushar/smellDetectionML/program/results/rq2/raw"
 
 TRAIN_VALIDATE_RATIO = 0.7
+RAGGED = False # Keep the samples ragged and pad each batch only to its largest sample (data_sequence.Sample2dSequence)
 # ------------
 
 
 def get_all_data(training_data_path, eval_data_path, smell):
     print("reading data...")
-    train_data, train_labels, eval_data, eval_labels, max_input_height, max_input_width = \
-        inputs.get_data_2d_rq2(training_data_path, eval_data_path, OUT_FOLDER, "rq2_cnn2d_" + smell,
-                               train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000)
+    if RAGGED:
+        train_data, eval_data, max_input_height, max_input_width = \
+            data_sequence.get_data_2d_rq2_sequences(training_data_path, eval_data_path, OUT_FOLDER,
+                                                    "rq2_cnn2d_" + smell, train_validate_ratio=TRAIN_VALIDATE_RATIO,
+                                                    max_training_samples=5000)
+        train_labels = train_data.labels
+        eval_labels = eval_data.labels
+    else:
+        train_data, train_labels, eval_data, eval_labels, max_input_height, max_input_width = \
+            inputs.get_data_2d_rq2(training_data_path, eval_data_path, OUT_FOLDER, "rq2_cnn2d_" + smell,
+                                   train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000)
     print("reading data... done.")
     return input_data.Input_data2(train_data, train_labels, eval_data, eval_labels,
                                   max_input_height, max_input_width)
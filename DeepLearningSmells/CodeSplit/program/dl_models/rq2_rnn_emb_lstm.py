@@ -6,6 +6,8 @@ import os
 import configuration
 import input_data
 import inputs
+import data_sequence
+import vocab_stats
 import datetime
 import gc
 import rq1_rnn_emb_lstm
@@ -32,6 +34,8 @@ else:
     OUT_FOLDER = "/users/pa18/tushar/smellDetectionML/learning_smells/results/rq2/raw"
 
 TRAIN_VALIDATE_RATIO = 0.7
+BUCKETING = False # Stream batches of samples with similar lengths, padded only to their longest sample
+VOCAB_SIZE = None # Most frequent token ids kept for the Embedding; the others share an out of vocabulary id
 
 
 # --------------------------
@@ -39,21 +43,33 @@ TRAIN_VALIDATE_RATIO = 0.7
 
 def get_all_data(training_data_path, eval_data_path, smell):
     print("reading data...")
+    max_features = vocab_stats.max_features(training_data_path, eval_data_path, vocab_size=VOCAB_SIZE)
 
     if smell in ["ComplexConditional", "ComplexMethod"]:
         max_eval_samples = 150000  # for impl smells (methods)
     else:
         max_eval_samples = 50000  # for design smells (classes)
 
+    if BUCKETING:
+        training_data, eval_data, max_input_length = \
+            data_sequence.get_data_rq2_sequences(training_data_path, eval_data_path, OUT_FOLDER, "rq2_rnn_" + smell,
+                                                 train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000,
+                                                 max_eval_samples=max_eval_samples, shuffle=True, token_ids=True,
+                                                 vocab_size=VOCAB_SIZE, bucket_by_length=True)
+        print("reading data... done.")
+        return input_data.Input_data(training_data, training_data.labels, eval_data, eval_data.labels,
+                                     max_input_length, max_features)
+
     training_data, training_labels, eval_data, eval_labels, max_input_length = \
         inputs.get_data_rq2(training_data_path, eval_data_path, OUT_FOLDER, "rq2_rnn_" + smell,
                             train_validate_ratio=TRAIN_VALIDATE_RATIO, max_training_samples=5000,
-                            max_eval_samples=max_eval_samples)
+                            max_eval_samples=max_eval_samples, token_ids=True, vocab_size=VOCAB_SIZE)
 
     training_data = training_data.reshape((len(training_labels), max_input_length))
     eval_data = eval_data.reshape((len(eval_labels), max_input_length))
     print("reading data... done.")
-    return input_data.Input_data(training_data, training_labels, eval_data, eval_labels, max_input_length)
+    return input_data.Input_data(training_data, training_labels, eval_data, eval_labels, max_input_length,
+                                 max_features)
 
 
 def write_result(file, str):
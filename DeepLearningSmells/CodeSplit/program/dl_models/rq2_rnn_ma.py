@@ -23,10 +23,11 @@ else:
     OUT_FOLDER = "/users/pa18/tushar/smellDetectionML/learning_smells/results/rq2/raw"
 # -----
 
-smell = "MultifacetedAbstraction"
+if __name__ == "__main__":
+    smell = "MultifacetedAbstraction"
 
-training_data_path = os.path.join(os.path.join(TRAINING_TOKENIZER_OUT_PATH, smell), DIM)
-eval_data_path = os.path.join(os.path.join(EVAL_TOKENIZER_OUT_PATH, smell), DIM)
-inputs.preprocess_data(training_data_path)
-inputs.preprocess_data(eval_data_path)
-rnn.main(training_data_path, eval_data_path, smell, skip_iter=9)
\ No newline at end of file
+    training_data_path = os.path.join(os.path.join(TRAINING_TOKENIZER_OUT_PATH, smell), DIM)
+    eval_data_path = os.path.join(os.path.join(EVAL_TOKENIZER_OUT_PATH, smell), DIM)
+    inputs.preprocess_data(training_data_path)
+    inputs.preprocess_data(eval_data_path)
+    rnn.main(training_data_path, eval_data_path, smell, skip_iter=9)
\ No newline at end of file
@@ -0,0 +1,59 @@
+import os
+import re
+import manifest
+
+# Rolling writer of sample shards (prefix + number + suffix, e.g. samples1.cvec, samples2.cvec, ...).
+# Samples go through a large write buffer and the writer counts the bytes itself, so it never stats or
+# reopens the shard it writes to. A new shard is started before a sample would make the current one
+# exceed max_bytes. The range of samples of every shard is recorded in a hidden index in the folder.
+MAX_SHARD_BYTES = 52428800
+WRITE_BUFFER = 8 << 20
+SHARD_INDEX = ".shards.json"
+
+
+class ShardWriter:
+    def __init__(self, folder, prefix="samples", suffix=".cvec", max_bytes=MAX_SHARD_BYTES,
+                 buffer_size=WRITE_BUFFER):
+        self.folder = folder
+        self.prefix = prefix
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.index_path = os.path.join(folder, SHARD_INDEX)
+        index = manifest.read_json(self.index_path)
+        self.shards = index["shards"] if index is not None else []
+        # Numbering continues after the shards already in the folder, which are listed only once here
+        pattern = re.compile(re.escape(prefix) + r"(\d+)" + re.escape(suffix) + "$")
+        numbers = [int(m.group(1)) for m in (pattern.match(f) for f in os.listdir(folder)) if m is not None]
+        self.number = max(numbers) if len(numbers) > 0 else 0
+        self.samples = sum(shard["count"] for shard in self.shards)
+        self.writer = None
+        self.shard = None
+
+    def _open(self):
+        self.number += 1
+        name = self.prefix + str(self.number) + self.suffix
+        self.writer = open(os.path.join(self.folder, name), "wb", buffering=self.buffer_size)
+        self.shard = {"file": name, "first": self.samples, "count": 0, "bytes": 0}
+        self.shards.append(self.shard)
+
+    def _close_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    # Writes one sample (text including its line break)
+    def write(self, sample):
+        data = sample.encode("utf-8", "surrogateescape")
+        if self.writer is None or (self.shard["bytes"] > 0 and self.shard["bytes"] + len(data) > self.max_bytes):
+            self._close_shard()
+            self._open()
+        self.writer.write(data)
+        self.shard["bytes"] += len(data)
+        self.shard["count"] += 1
+        self.samples += 1
+
+    def close(self):
+        self._close_shard()
+        manifest.write_json(self.index_path, {"prefix": self.prefix, "suffix": self.suffix,
+                                              "shards": self.shards})
@@ -0,0 +1,403 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+# Binary token store for a tokenizer output folder (e.g. <smell>/1d/Positive).
+# Every line of the text shards is one sample; the store keeps all the samples of the folder
+# in a flat values file and an offsets index (sample i is values[offsets[i]:offsets[i + 1]]).
+# Loading a folder from the store is a memory map instead of parsing the whole text again.
+# The store files start with "." so that the folder walkers in inputs.py skip them.
+VALUES_FILE = ".tokens.values"
+OFFSETS_FILE = ".tokens.offsets"
+META_FILE = ".tokens.json"
+
+# The 2d folders (one statement per line, samples separated by an empty line) have their own store:
+# the flat token values, the token offsets of every line and the line offsets of every sample
+# (line j of sample i is values[line_offsets[sample_offsets[i] + j]:line_offsets[sample_offsets[i] + j + 1]])
+VALUES_2D_FILE = ".tokens2d.values"
+LINES_2D_FILE = ".tokens2d.lines"
+SAMPLES_2D_FILE = ".tokens2d.samples"
+META_2D_FILE = ".tokens2d.json"
+
+# Number of rows (2d: samples) padded at a time; it bounds the size of the temporary index arrays
+PAD_CHUNK = 16384
+PAD_CHUNK_2D = 256
+
+# Number of processes parsing the text shards of a folder in parallel. The default 1 parses them in this
+# process; a script raising it (e.g. to os.cpu_count()) must guard its work with __main__ (see POOL_CONTEXT).
+PARSE_WORKERS = 1
+
+# The worker pools start fresh interpreters: the training scripts have already imported TensorFlow, whose
+# threads and locks do not survive a fork. A spawned worker imports the script that started the pool.
+POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+# The parsing pool is started by the first iter_shards call that needs one and reused by the following ones,
+# so a run pays the start of its workers once instead of once per folder
+_parse_pool = None
+_parse_pool_workers = 0
+
+
+def _source_files(folder):
+    return sorted(f for f in os.listdir(folder)
+                  if not f.startswith(".") and os.path.isfile(os.path.join(folder, f)))
+
+
+# Names, sizes and modification times of the text shards; the store is valid only for the same signature
+def folder_signature(folder):
+    signature = []
+    for f in _source_files(folder):
+        stat = os.stat(os.path.join(folder, f))
+        signature.append([f, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def _store_dtype(is_c2v):
+    if is_c2v:
+        return np.dtype(np.float32)
+    return np.dtype(np.int32)
+
+
+# Smallest integer dtype that holds the token ids from smallest to largest: uint16 when they fit,
+# int32 otherwise (the dtype the tokenizer output is parsed in)
+def range_dtype(smallest, largest):
+    iinfo = np.iinfo(np.uint16)
+    if smallest >= iinfo.min and largest <= iinfo.max:
+        return np.dtype(np.uint16)
+    return np.dtype(np.int32)
+
+
+# range_dtype of the token ids of the given value arrays
+def compact_dtype(value_arrays):
+    value_arrays = [values for values in value_arrays if len(values) > 0]
+    if len(value_arrays) == 0:
+        return np.dtype(np.uint16)
+    return range_dtype(min(int(np.min(values)) for values in value_arrays),
+                       max(int(np.max(values)) for values in value_arrays))
+
+
+def parse_line(line, is_c2v=False):
+    input_str = line.replace("\t", " ")
+    if is_c2v:
+        return np.fromstring(input_str, dtype=np.float64, sep=" ")
+    return np.fromstring(input_str, dtype=np.int32, sep=" ")
+
+
+# Applies func to every path on the shared pool of worker processes (in this process when workers is 1) and
+# yields the results in the order of paths
+def iter_shards(func, paths, workers=None):
+    if workers is None:
+        workers = PARSE_WORKERS
+    if min(workers, len(paths)) <= 1:
+        for path in paths:
+            yield func(path)
+        return
+    for result in _shared_pool(workers).map(func, paths):
+        yield result
+
+
+def _shared_pool(workers):
+    global _parse_pool, _parse_pool_workers
+    if _parse_pool is None or _parse_pool_workers != workers:
+        if _parse_pool is not None:
+            _parse_pool.shutdown()
+        _parse_pool = ProcessPoolExecutor(max_workers=workers, mp_context=POOL_CONTEXT)
+        _parse_pool_workers = workers
+    return _parse_pool
+
+
+def map_shards(func, paths, workers=None):
+    return list(iter_shards(func, paths, workers))
+
+
+# Parses one text shard into its flat token values and the length of each sample (line)
+def parse_shard(path, is_c2v=False):
+    dtype = _store_dtype(is_c2v)
+    samples = []
+    with open(path, "r", errors='ignore') as file_read:
+        for line in file_read:
+            samples.append(parse_line(line, is_c2v).astype(dtype, copy=False))
+    lengths = np.array([len(arr) for arr in samples], dtype=np.int64)
+    if len(samples) == 0:
+        return np.empty(0, dtype=dtype), lengths
+    return np.concatenate(samples), lengths
+
+
+def _parse_shards(folder, files, is_c2v, workers):
+    return iter_shards(partial(parse_shard, is_c2v=is_c2v), [os.path.join(folder, file) for file in files], workers)
+
+
+def _shard_offsets(shards):
+    offsets = np.zeros(sum(len(lengths) for _, lengths in shards) + 1, dtype=np.int64)
+    if len(shards) > 0:
+        np.cumsum(np.concatenate([lengths for _, lengths in shards]), out=offsets[1:])
+    return offsets
+
+
+def _to_ragged(shards, is_c2v):
+    offsets = _shard_offsets(shards)
+    if offsets[-1] == 0:
+        return np.empty(0, dtype=_store_dtype(is_c2v)), offsets
+    return np.concatenate([values for values, _ in shards]), offsets
+
+
+# Parses the text shards of the folder in a single pass (each line is parsed exactly once),
+# spread over workers processes, and returns the samples in the same ragged form as load_store
+def parse_folder(folder, is_c2v=False, workers=None):
+    return _to_ragged(list(_parse_shards(folder, _source_files(folder), is_c2v, workers)), is_c2v)
+
+
+# A 2d shard is parsed into its flat token values, the length of each line and the number of lines
+# of each sample. Like in the former _retrieve_data_2d, a sample is complete only when an empty line follows it.
+def parse_shard_2d(path):
+    values = []
+    line_lengths = []
+    sample_lines = []
+    cur_values = []
+    cur_lengths = []
+    with open(path, "r", errors='ignore') as file_read:
+        for line in file_read:
+            input_str = line.strip("\n").replace("\t", " ")
+            if input_str == "":  # end of current sample
+                if len(cur_lengths) > 0:
+                    values.extend(cur_values)
+                    line_lengths.extend(cur_lengths)
+                    sample_lines.append(len(cur_lengths))
+                cur_values = []
+                cur_lengths = []
+                continue
+            arr = np.fromstring(input_str, dtype=np.int32, sep=" ")
+            cur_values.append(arr)
+            cur_lengths.append(len(arr))
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int32), np.array(line_lengths, dtype=np.int64), \
+               np.array(sample_lines, dtype=np.int64)
+    return np.concatenate(values), np.array(line_lengths, dtype=np.int64), np.array(sample_lines, dtype=np.int64)
+
+
+def _to_offsets(lengths):
+    offsets = np.zeros(sum(len(arr) for arr in lengths) + 1, dtype=np.int64)
+    if len(lengths) > 0:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    return offsets
+
+
+def parse_folder_2d(folder, workers=None):
+    shards = list(iter_shards(parse_shard_2d, [os.path.join(folder, file) for file in _source_files(folder)],
+                              workers))
+    values = [values for values, _, _ in shards if len(values) > 0]
+    if len(values) == 0:
+        values = [np.empty(0, dtype=np.int32)]
+    return np.concatenate(values), _to_offsets([lengths for _, lengths, _ in shards]), \
+           _to_offsets([lines for _, _, lines in shards])
+
+
+def _write_meta(meta_path, dtype, samples, signature, **extra):
+    meta = {"dtype": np.dtype(dtype).name, "samples": samples, "signature": signature}
+    meta.update(extra)
+    with open(meta_path + ".tmp", "w") as meta_writer:
+        json.dump(meta, meta_writer)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def _read_meta(meta_path):
+    if not os.path.isfile(meta_path):
+        return None
+    try:
+        with open(meta_path, "r") as meta_reader:
+            return json.load(meta_reader)
+    except ValueError:
+        return None
+
+
+def _load_values(path, dtype, total):
+    if total == 0:
+        # np.memmap refuses empty files
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def build_store(folder, is_c2v=False, workers=None):
+    signature = folder_signature(folder)
+    writer = StoreWriter(folder, is_c2v)
+    for values, lengths in _parse_shards(folder, [file[0] for file in signature], is_c2v, workers):
+        writer.add_shard(values, lengths)
+    return writer.close(signature)
+
+
+# Writes the 1d store of a folder shard by shard, in the order of the shards in the signature given to close.
+# Only the sample lengths are kept; the values of each shard are written as soon as they are added. Besides
+# the signature, the meta file records the number of samples of every shard and the smallest and largest
+# token id (see token_range).
+class StoreWriter:
+    def __init__(self, folder, is_c2v=False):
+        self.is_c2v = is_c2v
+        self.dtype = _store_dtype(is_c2v)
+        self.values_path = os.path.join(folder, VALUES_FILE)
+        self.offsets_path = os.path.join(folder, OFFSETS_FILE)
+        self.meta_path = os.path.join(folder, META_FILE)
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        self.values_writer = open(self.values_path + ".tmp", "wb")
+        self.shard_lengths = []
+        self.token_range = None
+
+    def add_shard(self, values, lengths):
+        values.astype(self.dtype, copy=False).tofile(self.values_writer)
+        self.shard_lengths.append((None, lengths))
+        if not self.is_c2v and len(values) > 0:
+            shard_range = [int(np.min(values)), int(np.max(values))]
+            if self.token_range is None:
+                self.token_range = shard_range
+            else:
+                self.token_range = [min(self.token_range[0], shard_range[0]), max(self.token_range[1], shard_range[1])]
+
+    def close(self, signature):
+        self.values_writer.close()
+        offsets = _shard_offsets(self.shard_lengths)
+        offsets.tofile(self.offsets_path + ".tmp")
+        os.replace(self.values_path + ".tmp", self.values_path)
+        os.replace(self.offsets_path + ".tmp", self.offsets_path)
+
+        # The meta file is written last; a store without it is treated as missing
+        _write_meta(self.meta_path, self.dtype, len(offsets) - 1, signature,
+                    shards=[len(lengths) for _, lengths in self.shard_lengths],
+                    token_range=None if self.is_c2v else self.token_range or [0, 0])
+        return len(offsets) - 1
+
+
+# The samples of every shard of the current store of the folder as {shard: ((size, mtime), values, lengths)},
+# with the values memory mapped; empty when there is no store or it predates the per shard counts
+def stored_shards(folder, is_c2v=False):
+    meta = _read_meta(os.path.join(folder, META_FILE))
+    if meta is None or "shards" not in meta or meta["dtype"] != _store_dtype(is_c2v).name:
+        return {}
+    values, offsets = load_store(folder)
+    shards = {}
+    first = 0
+    for (name, size, mtime), count in zip(meta["signature"], meta["shards"]):
+        shards[name] = ((size, mtime), values[offsets[first]:offsets[first + count]],
+                        sample_lengths(offsets[first:first + count + 1]))
+        first += count
+    return shards
+
+
+def is_store_current(folder, is_c2v=False):
+    meta = _read_meta(os.path.join(folder, META_FILE))
+    return meta is not None and meta["dtype"] == _store_dtype(is_c2v).name \
+           and meta["signature"] == folder_signature(folder)
+
+
+# [smallest, largest] token id of the current 1d store of the folder ([0, 0] when it is empty), or None when
+# the store is out of date or does not record it
+def token_range(folder):
+    meta = _read_meta(os.path.join(folder, META_FILE))
+    if meta is None or meta.get("token_range") is None or meta["signature"] != folder_signature(folder):
+        return None
+    return meta["token_range"]
+
+
+def load_store(folder):
+    meta = _read_meta(os.path.join(folder, META_FILE))
+    offsets = np.fromfile(os.path.join(folder, OFFSETS_FILE), dtype=np.int64)
+    values = _load_values(os.path.join(folder, VALUES_FILE), np.dtype(meta["dtype"]), offsets[-1])
+    return values, offsets
+
+
+def build_store_2d(folder, workers=None):
+    signature = folder_signature(folder)
+    values_path = os.path.join(folder, VALUES_2D_FILE)
+    lines_path = os.path.join(folder, LINES_2D_FILE)
+    samples_path = os.path.join(folder, SAMPLES_2D_FILE)
+    meta_path = os.path.join(folder, META_2D_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    line_lengths = []
+    sample_lines = []
+    with open(values_path + ".tmp", "wb") as values_writer:
+        for values, lengths, lines in iter_shards(parse_shard_2d,
+                                                  [os.path.join(folder, file[0]) for file in signature], workers):
+            values.tofile(values_writer)
+            line_lengths.append(lengths)
+            sample_lines.append(lines)
+    _to_offsets(line_lengths).tofile(lines_path + ".tmp")
+    sample_offsets = _to_offsets(sample_lines)
+    sample_offsets.tofile(samples_path + ".tmp")
+    os.replace(values_path + ".tmp", values_path)
+    os.replace(lines_path + ".tmp", lines_path)
+    os.replace(samples_path + ".tmp", samples_path)
+
+    _write_meta(meta_path, np.int32, len(sample_offsets) - 1, signature)
+    return len(sample_offsets) - 1
+
+
+def is_store_2d_current(folder):
+    meta = _read_meta(os.path.join(folder, META_2D_FILE))
+    return meta is not None and meta["signature"] == folder_signature(folder)
+
+
+def load_store_2d(folder):
+    meta = _read_meta(os.path.join(folder, META_2D_FILE))
+    line_offsets = np.fromfile(os.path.join(folder, LINES_2D_FILE), dtype=np.int64)
+    sample_offsets = np.fromfile(os.path.join(folder, SAMPLES_2D_FILE), dtype=np.int64)
+    values = _load_values(os.path.join(folder, VALUES_2D_FILE), np.dtype(meta["dtype"]), line_offsets[-1])
+    return values, line_offsets, sample_offsets
+
+
+def sample_lengths(offsets):
+    return np.diff(offsets)
+
+
+# Position of every element inside its range, for consecutive ranges of the given lengths
+def _range_positions(lengths):
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+
+# Token ids through a vocabulary lookup table (see vocab_stats.remap_table): table[token + 1] is the new id
+# of token, table[0] the one of negative ids and table[-1] the one of ids beyond the table
+def remap_tokens(table, tokens):
+    return table[np.clip(tokens, -1, len(table) - 2) + 1]
+
+
+# Writes the given samples zero padded into the rows out_rows of out, which has to be zero initialized
+# and at least as wide as the longest of the samples. With a table, the token ids are remapped on the way.
+def pad_samples_into(values, offsets, samples, out, out_rows, table=None):
+    lengths = sample_lengths(offsets)
+    for start in range(0, len(samples), PAD_CHUNK):
+        rows = samples[start:start + PAD_CHUNK]
+        row_lengths = lengths[rows]
+        dest_rows = np.repeat(out_rows[start:start + PAD_CHUNK], row_lengths)
+        positions = _range_positions(row_lengths)
+        tokens = values[np.repeat(offsets[rows], row_lengths) + positions]
+        if table is not None:
+            tokens = remap_tokens(table, tokens)
+        out[dest_rows, positions] = tokens
+
+
+# The 2d counterpart of pad_samples_into: out is a zero initialized (samples, height, width) array;
+# lines beyond the height of out and tokens beyond its width are cut off
+def pad_samples_2d_into(values, line_offsets, sample_offsets, samples, out, out_rows):
+    height, width = out.shape[1], out.shape[2]
+    line_counts = sample_lengths(sample_offsets)
+    line_lengths = sample_lengths(line_offsets)
+    for start in range(0, len(samples), PAD_CHUNK_2D):
+        rows = samples[start:start + PAD_CHUNK_2D]
+        row_line_counts = np.minimum(line_counts[rows], height)
+        line_positions = _range_positions(row_line_counts)
+        lines = np.repeat(sample_offsets[rows], row_line_counts) + line_positions
+        line_dest_rows = np.repeat(out_rows[start:start + PAD_CHUNK_2D], row_line_counts)
+        lengths = np.minimum(line_lengths[lines], width)
+        positions = _range_positions(lengths)
+        out[np.repeat(line_dest_rows, lengths), np.repeat(line_positions, lengths), positions] = \
+            values[np.repeat(line_offsets[lines], lengths) + positions]
+
+
+# Returns the samples not longer than max_len as rows of a (samples, max_len) array padded with zeros
+def pad_samples(values, offsets, max_len, dtype=None):
+    selected = np.flatnonzero(sample_lengths(offsets) <= max_len)
+    out = np.zeros((len(selected), max_len), dtype=values.dtype if dtype is None else dtype)
+    pad_samples_into(values, offsets, selected, out, np.arange(len(selected)))
+    return out
@@ -0,0 +1,157 @@
+import os
+import numpy as np
+import manifest
+import token_store
+
+# Vocabulary statistics of a tokenized folder, computed with numpy over its token store: the largest token
+# id, the frequency of every id, its document frequency (number of samples it appears in) and the number
+# of negative ids and of ids equal to the padding value 0. The ids can be large and sparse, so the counts
+# are kept for the ids that occur only: "ids" (sorted) and the aligned "frequency" and "document_frequency"
+# arrays. They are cached in hidden files inside the folder (the scalar fields in a JSON file, the counts in
+# an npz file) and recomputed only when the folder signature changes, like the length histograms.
+VOCAB_FILE = ".vocab.json"
+VOCAB_2D_FILE = ".vocab2d.json"
+COUNTS_SUFFIX = ".npz"  # the counts file is the JSON file name with this suffix
+COUNT_KEYS = ["ids", "frequency", "document_frequency"]
+# Number of samples counted at a time; it bounds the size of the temporary (sample, token) pair arrays
+DOC_CHUNK = 65536
+
+
+# Token values, the token offsets of every sample and the largest token id when the store records it;
+# a 2d sample is all the tokens of its lines
+def _store_samples(folder, dimension):
+    if dimension == 2:
+        if not token_store.is_store_2d_current(folder):
+            token_store.build_store_2d(folder)
+        values, line_offsets, sample_offsets = token_store.load_store_2d(folder)
+        return values, line_offsets[sample_offsets], None
+    if not token_store.is_store_current(folder):
+        token_store.build_store(folder)
+    values, offsets = token_store.load_store(folder)
+    token_range = token_store.token_range(folder)
+    return values, offsets, None if token_range is None else token_range[1]
+
+
+# The counts of equal ids added together; the returned ids are sorted
+def _sum_by_id(ids, *counts):
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    return [unique_ids] + [np.bincount(inverse.ravel(), weights=c, minlength=len(unique_ids)).astype(np.int64)
+                           for c in counts]
+
+
+# largest_id saves a pass over values when it is already known
+def compute(values, offsets, largest_id=None):
+    n = len(offsets) - 1
+    if largest_id is None:
+        largest_id = int(np.max(values)) if len(values) > 0 else 0
+    max_id = max(largest_id, 0)
+    ids = []
+    frequency = []
+    document_ids = []
+    lengths = token_store.sample_lengths(offsets)
+    for start in range(0, n, DOC_CHUNK):
+        stop = min(start + DOC_CHUNK, n)
+        tokens = np.asarray(values[offsets[start]:offsets[stop]], dtype=np.int64)
+        samples = np.repeat(np.arange(stop - start, dtype=np.int64), lengths[start:stop])
+        valid = tokens >= 0
+        tokens = tokens[valid]
+        samples = samples[valid]
+        chunk_ids, chunk_frequency = np.unique(tokens, return_counts=True)
+        ids.append(chunk_ids)
+        frequency.append(chunk_frequency)
+        # Every (sample, token) pair is counted once
+        document_ids.append(np.unique(samples * (max_id + 1) + tokens) % (max_id + 1))
+    ids = np.concatenate(ids + [np.empty(0, dtype=np.int64)])
+    frequency = np.concatenate(frequency + [np.empty(0, dtype=np.int64)])
+    document_ids = np.concatenate(document_ids + [np.empty(0, dtype=np.int64)])
+    ids, frequency = _sum_by_id(ids, frequency)
+    document_frequency = np.zeros(len(ids), dtype=np.int64)
+    document_counts = _sum_by_id(document_ids, np.ones(len(document_ids)))
+    document_frequency[np.searchsorted(ids, document_counts[0])] = document_counts[1]
+    return {"samples": n, "tokens": int(offsets[-1]), "max_id": max_id,
+            "negative": int(np.count_nonzero(values < 0)), "padding": int(np.count_nonzero(values == 0)),
+            "ids": ids, "frequency": frequency, "document_frequency": document_frequency}
+
+
+def merge(stats1, stats2):
+    merged = {}
+    for key in ["samples", "tokens", "negative", "padding"]:
+        merged[key] = stats1[key] + stats2[key]
+    merged["max_id"] = max(stats1["max_id"], stats2["max_id"])
+    merged["ids"], merged["frequency"], merged["document_frequency"] = _sum_by_id(
+        np.concatenate([stats1["ids"], stats2["ids"]]),
+        np.concatenate([stats1["frequency"], stats2["frequency"]]),
+        np.concatenate([stats1["document_frequency"], stats2["document_frequency"]]))
+    return merged
+
+
+def _load_counts(path):
+    try:
+        with np.load(path) as counts:
+            return {key: counts[key].astype(np.int64, copy=False) for key in COUNT_KEYS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# The counts file is replaced before the JSON file, so a JSON file with the current signature always
+# comes with the matching counts
+def _save_counts(path, stats):
+    with open(path + manifest.TEMP_SUFFIX, "wb") as writer:
+        np.savez(writer, **{key: stats[key] for key in COUNT_KEYS})
+    os.replace(path + manifest.TEMP_SUFFIX, path)
+
+
+def folder_vocab(folder, dimension=1):
+    signature = token_store.folder_signature(folder)
+    path = os.path.join(folder, VOCAB_2D_FILE if dimension == 2 else VOCAB_FILE)
+    cached = manifest.read_json(path)
+    if cached is not None and cached.get("signature") == signature:
+        counts = _load_counts(path + COUNTS_SUFFIX)
+        if counts is not None:
+            stats = cached["stats"]
+            stats.update(counts)
+            return stats
+    stats = compute(*_store_samples(folder, dimension))
+    if stats["negative"] > 0:
+        print("\t" + str(stats["negative"]) + " negative token ids in " + folder)
+    try:
+        _save_counts(path + COUNTS_SUFFIX, stats)
+        manifest.write_json(path, {"signature": signature,
+                                   "stats": {key: value for key, value in stats.items() if key not in COUNT_KEYS}})
+    except OSError:
+        # A read only folder just means the statistics are recomputed next time
+        pass
+    return stats
+
+
+# The statistics of the label folders of data_path together
+def corpus_vocab(data_path, dimension=1):
+    stats = None
+    for folder in manifest.label_folders(data_path):
+        folder_stats = folder_vocab(folder, dimension)
+        stats = folder_stats if stats is None else merge(stats, folder_stats)
+    return stats
+
+
+# Lookup table for token_store.remap_tokens that numbers the top_k most frequent ids 1..top_k by decreasing
+# frequency (ties by id) and folds all the other ids, including unseen ones, into the OOV id top_k + 1.
+# 0 stays the padding value.
+def remap_table(stats, top_k):
+    ids = stats["ids"]
+    frequency = stats["frequency"]
+    ranked = np.lexsort((ids, -frequency))
+    ranked = ranked[ids[ranked] != 0][:top_k]
+    kept = ids[ranked]
+    oov = len(kept) + 1
+    table = np.full(stats["max_id"] + 3, oov, dtype=token_store.compact_dtype([np.array([oov])]))
+    table[kept + 1] = np.arange(1, len(kept) + 1)
+    table[1] = 0
+    return table
+
+
+# Largest token id the models fed with the samples of the given corpora see (Embedding input_dim is
+# max_features + 1). With vocab_size, the ids are remapped with the remap_table of the first corpus.
+def max_features(*data_paths, vocab_size=None):
+    if vocab_size is not None:
+        return int(np.max(remap_table(corpus_vocab(data_paths[0]), vocab_size)))
+    return max(corpus_vocab(data_path)["max_id"] for data_path in data_paths)
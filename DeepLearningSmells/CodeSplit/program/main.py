@@ -10,7 +10,11 @@ def main():
     tokenizer_out_base_path = r'C:\WorkSpace\Swetha_M20AIE317_SDE_PRJS\DeepLearningSmells\data\tokenizer_cs1'
     tokenizer_exe_path = r'C:\WorkSpace\Swetha_M20AIE317_SDE_PRJS\tokenizer\src\tokenizer.exe'
 
-    tokenizer_runner.tokenize(tokenizer_language, tokenizer_input_base_path, tokenizer_out_base_path, tokenizer_exe_path)
+    # --force tokenizes everything again instead of resuming an interrupted run
+    force = "--force" in sys.argv[1:]
+
+    tokenizer_runner.tokenize(tokenizer_language, tokenizer_input_base_path, tokenizer_out_base_path,
+                              tokenizer_exe_path, force=force)
 
 
 if __name__ == '__main__':